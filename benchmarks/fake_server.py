@@ -0,0 +1,123 @@
+"""
+Local stand-in for histdata.com, serving token pages and synthetic archives.
+
+The referer pages look like the real ones (a full HTML page with the <input id="tk"> field),
+and get.php answers with a DAT_*.zip holding a CSV of the requested time frame:
+M1 bars ('20190601 170000;open;high;low;close;0'), ASCII ticks
+('20190601 170000123,bid,ask,0') or NinjaTrader ticks ('20190601 170000;price;0').
+"""
+import io
+import os
+import sys
+import threading
+import zipfile
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from histdata.timezone import format_timestamps
+
+TOKEN = 'f3c1a2b4d5e6f7a8b9c0d1e2f3a4b5c6'
+
+# Roughly the size of the real pages: the token is buried in a lot of markup.
+TOKEN_PAGE = ('<!DOCTYPE html><html><head><title>HistData.com</title></head><body>' +
+              '<div class="menu"><a href="/">Home</a></div>' * 400 +
+              '<form id="file_down" name="file_down" method="POST" action="get.php">'
+              f'<input type="hidden" name="tk" id="tk" value="{TOKEN}" />'
+              '<input type="hidden" name="date" id="date" value="2019" /></form>' +
+              '<p>lorem ipsum dolor sit amet</p>' * 400 +
+              '</body></html>').encode()
+
+
+def synthetic_csv(time_frame, rows, start='2019-06-02T17:00', seed=0):
+    """
+    CSV content of a synthetic archive with `rows` lines, starting at `start`.
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64(start, 's').astype(np.int64)
+    if time_frame == 'M1':
+        seconds = start + np.arange(rows, dtype=np.int64) * 60
+    else:
+        seconds = start + np.sort(rng.integers(0, rows * 2, rows)).astype(np.int64)
+    stamps = format_timestamps(seconds).view('S15').ravel().astype(str)
+    price = 1.1 + np.cumsum(rng.normal(0, 1e-5, rows))
+    lines = []
+    if time_frame == 'M1':
+        spread = np.abs(rng.normal(0, 5e-5, rows))
+        for s, o, h, l, c in zip(stamps, price, price + spread, price - spread, price + spread / 2):
+            lines.append(f'{s};{o:.6f};{h:.6f};{l:.6f};{c:.6f};0')
+    elif time_frame == 'T':
+        millis = rng.integers(0, 1000, rows)
+        for s, ms, b in zip(stamps, millis, price):
+            lines.append(f'{s}{ms:03d},{b:.5f},{b + 1.5e-4:.5f},0')
+    else:
+        for s, p in zip(stamps, price):
+            lines.append(f'{s};{p:.5f};0')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+@lru_cache(maxsize=256)
+def synthetic_zip(platform, pair, time_frame, period, rows):
+    """
+    Archive as served by get.php for a period ('2019' or '201906'). The data starts on the first day of the period.
+    """
+    name = f'DAT_{platform}_{pair}_{time_frame}_{period}'
+    start = f'{period[:4]}-{period[4:6] or "01"}-01T00:00'
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr(name + '.csv', synthetic_csv(time_frame, rows, start))
+        z.writestr(name + '.txt', 'HistData.com (c) 2019\nGap of 120s found between 20190602170000 and 20190602170200.\n')
+    return buf.getvalue()
+
+
+class FakeHistData(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, rows=40_000, tick_rows=500_000, address=('127.0.0.1', 0)):
+        super().__init__(address, _Handler)
+        self.rows = rows
+        self.tick_rows = tick_rows
+        self.requests = 0
+
+    def archive(self, platform, pair, time_frame, period):
+        rows = self.rows if time_frame == 'M1' else self.tick_rows
+        return synthetic_zip(platform, pair.upper(), time_frame, str(period), rows)
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real site.
+    # Like any production server. Without it, headers and body of a keep-alive response
+    # are held back by Nagle's algorithm until the client's delayed ACK (~40ms per response).
+    disable_nagle_algorithm = True
+
+    def _send(self, body, content_type):
+        self.server.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send(TOKEN_PAGE, 'text/html')
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        field = lambda name: form[name][0]
+        assert field('tk') == TOKEN
+        body = self.server.archive(field('platform'), field('fxpair'), field('timeframe'), field('datemonth'))
+        self._send(body, 'application/zip')
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,363 @@
+"""
+Benchmarks of the download, parse, ingest and cleanup hot paths against a local fake histdata server.
+
+Every stage runs in a fresh (spawned) process, so peak RSS is not polluted by the other stages.
+A stage is run once for wall time, throughput and peak RSS, then once more under tracemalloc for
+the peak of Python allocated memory and the number of allocations made by the stage. Results are written as JSON, and two result files can be compared:
+
+    python benchmarks/run.py --output bench_output.json
+    python benchmarks/run.py --compare old.json new.json
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Stage:
+    """
+    A benchmark stage. setup() prepares the inputs and imports the modules used (not measured), run()
+    does the measured work and returns the number of rows and bytes it processed.
+    """
+    name = None
+
+    def __init__(self, config, workdir):
+        self.config = config
+        self.workdir = workdir
+
+    def setup(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError
+
+
+# Modules the raw download path must not pull in, and its import time budget on a typical machine.
+HEAVY_MODULES = ('pandas', 'pyarrow', 'deltalake', 'numpy', 'bs4')
+IMPORT_BUDGET_SECONDS = 0.3
+
+
+class Import(Stage):
+    """Import histdata and download_hist_data in a fresh interpreter. Fails if heavy dependencies get imported."""
+    name = 'import'
+
+    def run(self):
+        from histdata import download_hist_data  # noqa: F401
+
+        loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+        if loaded:
+            raise AssertionError(f'Importing download_hist_data loaded {", ".join(loaded)}.')
+        return dict(rows=0, bytes=0)
+
+
+def _server(config):
+    from fake_server import FakeHistData
+
+    return FakeHistData(rows=config['rows'], tick_rows=config['tick_rows']).start()
+
+
+def _months(count):
+    return [(2000 + i // 12, i % 12 + 1) for i in range(count)]
+
+
+class Fetch(Stage):
+    """GET the token page and POST for the archive, through the pooled HistDataClient."""
+    name = 'fetch'
+
+    def make_client(self, url):
+        from histdata.api import HistDataClient
+
+        return HistDataClient(base_url=url)
+
+    def setup(self):
+        self.server = _server(self.config)
+        self.client = self.make_client(self.server.url)
+        for year, month in _months(self.config['requests']):
+            self.server.archive('ASCII', 'eurusd', 'M1', f'{year}{month:02d}')
+
+    def run(self):
+        size = 0
+        for year, month in _months(self.config['requests']):
+            size += len(self.client.download(year, month, 'eurusd', 'M1', 'ASCII').content)
+        return dict(rows=self.config['requests'] * self.config['rows'], bytes=size)
+
+
+class FetchUnpooled(Fetch):
+    """Same as fetch, with a new connection per request (requests.get/post, the old behaviour)."""
+    name = 'fetch_unpooled'
+
+    def make_client(self, url):
+        import requests
+        from histdata.api import HistDataClient
+
+        return HistDataClient(transport=requests, base_url=url)
+
+
+class _Archive(Stage):
+    def setup(self):
+        from fake_server import synthetic_zip
+
+        self.archive = synthetic_zip('ASCII', 'EURUSD', 'M1', '201906', self.config['rows'])
+
+
+class ParsePandas(_Archive):
+    """Unzip and parse an M1 archive with extract_data (pandas)."""
+    name = 'parse_pandas'
+
+    def setup(self):
+        super().setup()
+        from histdata.api import extract_data
+
+        self.extract_data = extract_data
+        # pandas is imported on the first call.
+        self.extract_data(io.BytesIO(self.archive))
+
+    def run(self):
+        df = self.extract_data(io.BytesIO(self.archive))
+        return dict(rows=len(df), bytes=len(self.archive))
+
+
+class ParseArrow(_Archive):
+    """Unzip and parse an M1 archive in record batches with pyarrow (streaming ingest path)."""
+    name = 'parse_arrow'
+
+    def setup(self):
+        super().setup()
+        from histdata.ingest import m1_batches
+
+        self.m1_batches = m1_batches
+        # pyarrow imports pandas on the first conversion.
+        sum(b.num_rows for b in self.m1_batches(io.BytesIO(self.archive), 'eurusd'))
+
+    def run(self):
+        rows = sum(b.num_rows for b in self.m1_batches(io.BytesIO(self.archive), 'eurusd'))
+        return dict(rows=rows, bytes=len(self.archive))
+
+
+class DeltaWrite(Stage):
+    """Download archives into a fresh Delta table with download_hist_data(delta_lake=True)."""
+    name = 'delta_write'
+    stream = False
+
+    def setup(self):
+        from histdata.api import HistDataClient, download_hist_data
+        import deltalake, pandas, pyarrow  # noqa: F401,E401 (imported on the first write otherwise)
+
+        self.download_hist_data = download_hist_data
+        self.server = _server(self.config)
+        self.client = HistDataClient(base_url=self.server.url)
+        self.table = os.path.join(self.workdir, self.name)
+        for year in self.years():
+            self.server.archive('ASCII', 'eurusd', 'M1', year)
+
+    def years(self):
+        return range(2000, 2000 + self.config['years'])
+
+    def run(self):
+        # Past periods have to be requested per year.
+        years = self.years()
+        for year in years:
+            self.download_hist_data(year=year, pair='eurusd', output_directory=self.table,
+                               verbose=False, delta_lake=True, client=self.client, stream=self.stream)
+        rows = len(years) * self.config['rows']
+        return dict(rows=rows, bytes=_directory_size(self.table))
+
+
+class DeltaWriteStream(DeltaWrite):
+    """Same as delta_write through the streaming Arrow ingest (stream=True)."""
+    name = 'delta_write_stream'
+    stream = True
+
+
+def _write_months(table, months, rows, copies=1):
+    from fake_server import synthetic_zip
+    from histdata.ingest import m1_reader, write_delta
+
+    for year, month in months:
+        archive = synthetic_zip('ASCII', 'EURUSD', 'M1', f'{year}{month:02d}', rows)
+        for _ in range(copies):
+            write_delta(table, m1_reader(io.BytesIO(archive), 'eurusd'), 'eurusd', year)
+
+
+class Resume(Stage):
+    """Find where the dt_download planner resumes a pair, from the Delta log."""
+    name = 'resume'
+
+    def setup(self):
+        from deltalake import DeltaTable
+        from histdata.delta import high_water_mark
+
+        self.DeltaTable, self.high_water_mark = DeltaTable, high_water_mark
+        self.table = os.path.join(self.workdir, self.name)
+        _write_months(self.table, _months(self.config['months']), self.config['rows'])
+
+    def run(self):
+        dt = self.DeltaTable(self.table)
+        self.high_water_mark(dt, 'eurusd')
+        return dict(rows=0, bytes=_directory_size(self.table))
+
+
+class DedupCompact(Stage):
+    """Deduplicate and compact one (pair, year) partition holding every row twice (dt_clean)."""
+    name = 'dedup_compact'
+
+    def setup(self):
+        from dt_clean import clean_partition
+
+        self.clean_partition = clean_partition
+        self.table = os.path.join(self.workdir, self.name)
+        _write_months(self.table, _months(12), self.config['rows'] // 12 or 1, copies=2)
+
+    def run(self):
+        size = _directory_size(self.table)
+        report = self.clean_partition(self.table, 'EURUSD', 2000)
+        return dict(rows=report['duplicates'] * 2, bytes=size)
+
+
+class TickIngest(Stage):
+    """Parse a tick archive and write the tick and bar tables (histdata.ticks)."""
+    name = 'tick_ingest'
+
+    def setup(self):
+        from fake_server import synthetic_zip
+        from histdata.ticks import ingest_ticks
+        import deltalake, pandas, pyarrow  # noqa: F401,E401 (imported on the first write otherwise)
+
+        self.ingest_ticks = ingest_ticks
+        self.archive = synthetic_zip('ASCII', 'EURUSD', 'T', '201906', self.config['tick_rows'])
+        self.ticks = os.path.join(self.workdir, 'ticks')
+
+    def run(self):
+        ticks, _ = self.ingest_ticks(io.BytesIO(self.archive), 'eurusd', 'T', self.ticks, self.ticks + '_bars')
+        return dict(rows=ticks, bytes=len(self.archive))
+
+
+STAGES = [Import, Fetch, FetchUnpooled, ParsePandas, ParseArrow, DeltaWrite, DeltaWriteStream, Resume, DedupCompact,
+          TickIngest]
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _measure(stage_name, config, trace):
+    """
+    Run one stage in the current (fresh) process.
+    """
+    stage_class = next(s for s in STAGES if s.name == stage_name)
+    workdir = tempfile.mkdtemp(prefix=f'bench_{stage_name}_')
+    try:
+        stage = stage_class(config, workdir)
+        stage.setup()
+        rss_start = _rss_bytes()
+        if trace:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        result = stage.run()
+        seconds = time.perf_counter() - start
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            # tracemalloc only sees the blocks alive when a snapshot is taken: the count is that of the
+            # allocations of the stage not freed by its end, the temporaries it freed are not counted.
+            diff = tracemalloc.take_snapshot().compare_to(before, 'filename')
+            tracemalloc.stop()
+            return dict(alloc_peak_bytes=peak, allocations=sum(s.count_diff for s in diff))
+        # ru_maxrss is in kilobytes on Linux.
+        return dict(seconds=seconds,
+                    rows=result['rows'],
+                    bytes=result['bytes'],
+                    rows_per_second=result['rows'] / seconds if seconds else None,
+                    mb_per_second=result['bytes'] / seconds / 1e6 if seconds else None,
+                    rss_start_bytes=rss_start,
+                    rss_peak_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_stage(stage_name, config, trace_allocations=True):
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        result = pool.apply(_measure, (stage_name, config, False))
+    if trace_allocations:
+        with context.Pool(1) as pool:
+            result.update(pool.apply(_measure, (stage_name, config, True)))
+    return result
+
+
+def compare(old_path, new_path):
+    """
+    Print the change of every metric between two result files.
+    """
+    with open(old_path) as f:
+        old = json.load(f)['stages']
+    with open(new_path) as f:
+        new = json.load(f)['stages']
+    for name in new:
+        if name not in old:
+            continue
+        for metric in ('seconds', 'rows_per_second', 'rss_peak_bytes', 'alloc_peak_bytes', 'allocations'):
+            a, b = old[name].get(metric), new[name].get(metric)
+            if a and b:
+                print(f'{name:20s} {metric:18s} {a:14.4g} -> {b:14.4g} ({(b - a) / a:+.1%})')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', default=','.join(s.name for s in STAGES),
+                        help='Comma separated list of stages to run.')
+    parser.add_argument('--rows', type=int, default=40_000, help='M1 rows per synthetic archive (about a month).')
+    parser.add_argument('--tick-rows', type=int, default=500_000, help='Ticks per synthetic tick archive.')
+    parser.add_argument('--requests', type=int, default=20, help='Downloads in the fetch stages.')
+    parser.add_argument('--months', type=int, default=12, help='Monthly archives written in the resume stage.')
+    parser.add_argument('--years', type=int, default=12, help='Yearly archives downloaded in the delta_write stages.')
+    parser.add_argument('--no-allocations', action='store_true', help='Skip the tracemalloc runs.')
+    parser.add_argument('--output', default='bench_output.json', help='Where to write the JSON results.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files and exit.')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    config = dict(rows=args.rows, tick_rows=args.tick_rows, requests=args.requests, months=args.months,
+                  years=args.years)
+    results = dict(config=config,
+                   python=platform.python_version(),
+                   machine=platform.machine(),
+                   cpus=os.cpu_count(),
+                   timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   stages={})
+    failures = []
+    for name in args.stages.split(','):
+        results['stages'][name] = run_stage(name, config, not args.no_allocations)
+        stage = results['stages'][name]
+        if name == Import.name and stage['seconds'] > IMPORT_BUDGET_SECONDS:
+            failures.append(f"import took {stage['seconds']:.3f}s, over the {IMPORT_BUDGET_SECONDS}s budget")
+        print(f"{name:20s} {stage['seconds']:8.3f}s {stage['rows_per_second'] or 0:14,.0f} rows/s "
+              f"{stage['mb_per_second'] or 0:8.2f} MB/s peak RSS {stage['rss_peak_bytes'] / 1e6:8.1f} MB")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'Results written to {args.output}')
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,91 @@
-import csv
 import os
 import sys
-from datetime import datetime
-from datetime import timedelta
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from histdata.timezone import convert_stream, from_est, parse_target
 from fx_logging import get_project_logger
 
 # Setup logging
 logger = get_project_logger(__name__)
 
-if __name__ == '__main__':
 
-    args = sys.argv
-    if len(args) != 3:
-        logger.error('Usage: {0} <filename> <time zone difference>\n' \
-              'Example: {0} DAT_ASCII_EURJPY_M1_201705.csv +13'.format(args[0].split(os.sep)[-1]))
+def output_path(input_filename):
+    directory, name = os.path.split(os.path.normpath(input_filename))
+    return os.path.join(directory, 'OUT_' + name)
+
+
+def convert_csv(input_filename, output_filename, target):
+    with open(input_filename, 'rb') as r, open(output_filename, 'wb') as w:
+        convert_stream(r, w, target)
+
+
+def convert_zip(input_filename, output_filename, target):
+    """
+    Convert the CSV member of a DAT_*.zip archive, streaming it from the old archive to the new one.
+    The other members (the status report) are copied as they are.
+    """
+    with ZipFile(input_filename, 'r') as r, ZipFile(output_filename, 'w', ZIP_DEFLATED) as w:
+        for info in r.infolist():
+            with r.open(info) as src, w.open(info.filename, 'w', force_zip64=True) as dst:
+                if info.filename.endswith('.csv'):
+                    convert_stream(src, dst, target)
+                else:
+                    dst.write(src.read())
+
+
+def convert_delta(input_table, output_table, target, pairs=None):
+    """
+    Convert the date column of the Delta table into another Delta table, one batch at a time.
+    The year partition is recomputed from the converted dates. The converted pairs replace those
+    already in the output table, so converting again does not duplicate rows.
+    :param pairs: Only convert these pairs (default: all, and the output table is replaced).
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    from deltalake import DeltaTable, write_deltalake
+
+    dataset = DeltaTable(input_table).to_pyarrow_dataset()
+    pairs = sorted({p.upper() for p in pairs}) if pairs else None
+    condition = ds.field('pair').isin(pairs) if pairs else None
+    # A row can change year when converted, so the pairs are replaced as a whole, not year by year.
+    predicate = 'pair IN ({})'.format(', '.join(f"'{p}'" for p in pairs)) if pairs else None
+    schema = dataset.schema
+
+    def batches():
+        for batch in dataset.to_batches(filter=condition):
+            seconds = pc.divide(batch.column('date').cast(pa.int64()), 1_000_000).to_numpy()
+            date = pa.array(from_est(seconds, target).astype('datetime64[s]')).cast(pa.timestamp('us'))
+            columns = {name: batch.column(name) for name in schema.names}
+            columns['date'] = date
+            columns['year'] = pc.year(date).cast(schema.field('year').type)
+            yield pa.record_batch([columns[name] for name in schema.names], schema=schema)
+
+    write_deltalake(output_table, pa.RecordBatchReader.from_batches(schema, batches()),
+                    mode='overwrite', predicate=predicate, partition_by=['pair', 'year'])
+
+
+def main(args):
+    if len(args) < 3:
+        logger.error('Usage: {0} <filename|zip|delta table> <time zone difference|IANA time zone> [pair ...]\n'
+                     'Example: {0} DAT_ASCII_EURJPY_M1_201705.csv +13\n'
+                     'Example: {0} DAT_ASCII_EURJPY_M1_201705.zip Asia/Tokyo\n'
+                     'Example: {0} output Europe/London eurusd'.format(args[0].split(os.sep)[-1]))
+        return
+    input_filename = args[1]
+    target = parse_target(args[2])
+    output_filename = output_path(input_filename)
+    logger.info(f"Converting timezone for {input_filename} to {target}")
+
+    if os.path.isdir(input_filename):
+        convert_delta(input_filename, output_filename, target, pairs=args[3:])
+    elif input_filename.lower().endswith('.zip'):
+        convert_zip(input_filename, output_filename, target)
     else:
-        time_zone_difference = int(args[2])
-        input_filename = args[1]
-        output_filename = 'OUT_' + input_filename
-        logger.info(f"Converting timezone for {input_filename} with offset {time_zone_difference} hours")
-        
-        with open(output_filename, 'w') as w:
-            with open(input_filename, 'r') as r:
-                reader = csv.reader(r, delimiter=';')
-                for row in reader:
-                    logger.debug(f"Processing row: {row}")
-                    new_row = list(row)
-                    ts = datetime.strptime(new_row[0], '%Y%m%d %H%M%S')
-                    ts += timedelta(hours=time_zone_difference)
-                    new_row[0] = ts.strftime('%Y%m%d %H%M%S')
-                    w.write(';'.join(new_row) + '\n')
-        
-        logger.info(f"Conversion complete. Output written to {output_filename}")
+        convert_csv(input_filename, output_filename, target)
+
+    logger.info(f"Conversion complete. Output written to {output_filename}")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,6 +1,8 @@
-import csv
+import functools
 import os
+from histdata import metrics, plan
 from histdata.api import download_hist_data
+from histdata.concurrency import polite, settings_from_env
 from fx_logging import get_project_logger
 
 # Setup logging
@@ -18,45 +20,60 @@ def mkdir_p(path):
             raise
 
 
-def download_all():
+def download_job(job, output, download=download_hist_data, output_format='zip'):
+    """
+    Download the archive of a planned job (see histdata.plan) into output/<pair>/.
+    An archive already there was written before the end of its period (the planner left it to do):
+    it is replaced, and put back if the download fails.
+    """
+    output_folder = os.path.join(output, job['pair'].lower())
+    mkdir_p(output_folder)
+    path = plan.archive_path(output, job['pair'], job['year'], job['month'], output_format=output_format)
+    partial = path + '.partial'
+    if os.path.exists(path):
+        os.replace(path, partial)
+    logger.debug("Downloading %s", job['key'])
+    try:
+        result = download(year=job['year'], month=job['month'], pair=job['pair'].lower(),
+                          output_directory=output_folder, verbose=False)
+    except BaseException:
+        if os.path.exists(partial):
+            os.replace(partial, path)
+        raise
+    if os.path.exists(partial):
+        os.remove(partial)
+    logger.info(f"Downloaded {job['key']}: {result}")
+    return result
+
+
+def download_all(workers=None, rate=None, retries=None):
+    """
+    Download every pair listed in pairs.csv.
+    The archives to fetch are planned from the first trading month of each pair and the files
+    already in the output folder, and tracked in a manifest (see histdata.plan): an interrupted
+    run resumes where it stopped, and a failed archive does not stop the rest of its pair.
+    With workers > 1, pairs are downloaded concurrently. Each pair still walks its
+    years/months in order, so the files written are the same as a sequential run.
+    Defaults come from FX_DATA_WORKERS, FX_DATA_RATE and FX_DATA_RETRIES.
+    FX_DATA_FORMAT=parquet writes a Parquet file per period instead of the ZIP archive.
+    With FX_DATA_METRICS set, the stages of every download are timed (see histdata.metrics).
+    """
+    metrics.configure_from_env()
     output = os.environ.get("FX_DATA_OUTPUT", 'output')
+    output_format = os.environ.get("FX_DATA_FORMAT", 'zip')
+    settings = settings_from_env(workers)
+    workers = settings['workers']
+    rate = settings['rate'] if rate is None else rate
+    retries = settings['retries'] if retries is None else retries
+    download = polite(functools.partial(download_hist_data, output_format=output_format),
+                      rate=rate, retries=retries)
 
-    with open('pairs.csv', 'r') as f:
-        reader = csv.reader(f, delimiter=',')
-        next(reader, None)  # skip the headers
-        for row in reader:
-            currency_pair_name, pair, history_first_trading_month = row
-            year = int(history_first_trading_month[0:4])
-            logger.info(f"Starting download for {currency_pair_name}")
-            output_folder = os.path.join(output, pair)
-            mkdir_p(output_folder)
-            try:
-                while True:
-                    could_download_full_year = False
-                    try:
-                        logger.debug(f"Attempting to download full year {year} for {pair}")
-                        result = download_hist_data(year=year,
-                                                      pair=pair,
-                                                      output_directory=output_folder,
-                                                      verbose=False)
-                        logger.info(f"Successfully downloaded year {year} for {pair}: {result}")
-                        could_download_full_year = True
-                    except AssertionError:
-                        logger.debug(f"Full year download failed for {year}, trying month by month")
-                        pass  # lets download it month by month.
-                    month = 1
-                    while not could_download_full_year and month <= 12:
-                        logger.debug(f"Downloading month {month}/{year} for {pair}")
-                        result = download_hist_data(year=str(year),
-                                                      month=str(month),
-                                                      pair=pair,
-                                                      output_directory=output_folder,
-                                                      verbose=False)
-                        logger.info(f"Downloaded month {month}/{year} for {pair}: {result}")
-                        month += 1
-                    year += 1
-            except Exception as e:
-                logger.info(f"Download complete for currency {currency_pair_name}: {e}")
+    manifest = plan.Manifest.for_output(output, output_format)
+    manifest.update(plan.plan(plan.read_pairs(), done=plan.zip_done(output, output_format=output_format)))
+    with metrics.span('execute'):
+        plan.execute(manifest, lambda job: download_job(job, output, download=download, output_format=output_format),
+                     workers=workers)
+    metrics.report()
 
 
 if __name__ == '__main__':
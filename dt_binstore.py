@@ -0,0 +1,38 @@
+import os
+from deltalake import DeltaTable
+from histdata import metrics
+from histdata.binstore import BarStore
+from histdata.delta import partitions
+
+from fx_logging import get_project_logger
+
+# Setup logging
+logger = get_project_logger(__name__)
+
+
+def main():
+    """
+    Export the M1 bars to the memory-mapped bar store (see histdata.binstore) at FX_DATA_BINSTORE
+    (default FX_DATA_OUTPUT + '_bin'), from the Delta table at FX_DATA_OUTPUT or, when it is not a
+    Delta table, from the DAT_ASCII_*_M1_*.zip archives under it. Only the bars later than the last
+    stored bar of each pair are appended, so it can run after every download.
+    """
+    metrics.configure_from_env()
+    output = os.environ.get("FX_DATA_OUTPUT", 'output')
+    store = BarStore(os.environ.get("FX_DATA_BINSTORE", f"{output}_bin"))
+
+    if DeltaTable.is_deltatable(output):
+        pairs = sorted({p['pair'] for p in partitions(DeltaTable(output))})
+        logger.info(f"Exporting {len(pairs)} pairs from the Delta table {output} to {store.root}")
+        for pair in pairs:
+            with metrics.span('binstore', pair=pair) as span:
+                span.add(rows=store.export_delta(output, pair))
+    else:
+        logger.info(f"Exporting the archives under {output} to {store.root}")
+        with metrics.span('binstore') as span:
+            span.add(rows=sum(store.export_archives(output).values()))
+    metrics.report()
+
+
+if __name__ == "__main__":
+    main()
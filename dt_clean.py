@@ -1,57 +1,223 @@
+import json
+import multiprocessing
 import os
-import pandas as pd
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
 from deltalake import write_deltalake, DeltaTable
-from histdata.api import download_hist_data
+from deltalake.exceptions import CommitFailedError
+from histdata import catalog, metrics
+from histdata.delta import (date_stats_missing, load_state, pair_files, partition_filters, partition_predicate,
+                           partitions, save_state, scan_cost)
 
 from fx_logging import get_project_logger
 
 # Setup logging
 logger = get_project_logger(__name__)
 
+# A partition is roughly this many times bigger in memory than its snappy parquet files,
+# counting the sorted and deduplicated copies held while it is cleaned.
+MEMORY_EXPANSION = 8
+
+LAYOUTS = ('compact', 'sort', 'zorder')
+
+# Commits of a partition that conflict with those of other workers are tried again this many times.
+COMMIT_ATTEMPTS = 10
+
+
+def drop_duplicates(table):
+    """
+    Sort an Arrow table by date and keep the first row of each (date, pair).
+    The table holds a single partition, so the pair is the same on every row.
+    """
+    table = table.sort_by('date')
+    if table.num_rows < 2:
+        return table
+    dates = table['date'].combine_chunks()
+    changed = pc.not_equal(dates.slice(1), dates.slice(0, len(dates) - 1))
+    keep = pa.concat_arrays([pa.array([True]), changed])
+    return table.filter(keep)
+
+
+def _retry(operation, pair, year, attempts=COMMIT_ATTEMPTS):
+    """
+    Run a Delta operation on a partition, running it again when its commit conflicts with a commit of
+    another worker. The workers rewrite disjoint partitions, but deltalake's conflict checker still
+    rejects an overwrite committed after another transaction removed files of the table.
+    :raises RuntimeError: The operation still conflicts after all attempts (CommitFailedError does not
+                          survive the trip back from a worker process).
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return operation()
+        except CommitFailedError as e:
+            if attempt == attempts:
+                raise RuntimeError(f'{pair} {year}: commit failed {attempts} times: {e}') from None
+            logger.debug(f'{pair} {year}: commit conflict, attempt {attempt}: {e}')
+            time.sleep(random.uniform(0, 0.1 * attempt))
+
+
+def clean_partition(output, pair, year, dedup=True, layout='compact', target_size=None):
+    """
+    Deduplicate a single (pair, year) partition, write it back and lay its files out.
+    Runs in a worker process: the partition is only ever held in memory by that worker.
+    :param layout: 'compact' bin-packs small files together. 'sort' rewrites the partition sorted by
+                   date, and 'zorder' has deltalake's optimizer z-order it on date: in both cases the
+                   files end up with disjoint date ranges, so range queries can skip them.
+    :param target_size: Target size in bytes of the files written (default: deltalake's).
+    :return: Report with the duplicates removed, files compacted, bytes rewritten, files lacking
+             date statistics and seconds spent.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f'Unknown layout: {layout}')
+    start = time.perf_counter()
+    duplicates = 0
+    bytes_rewritten = 0
+    files_removed = 0
+    if dedup or layout == 'sort':
+        table = DeltaTable(output).to_pyarrow_table(partitions=partition_filters(pair, year))
+        deduped = drop_duplicates(table) if dedup else table.sort_by('date')
+        duplicates = table.num_rows - deduped.num_rows
+        del table
+        if duplicates or layout == 'sort':
+            files = pair_files(DeltaTable(output), pair)
+            files_removed = files.filter(pc.equal(files['partition.year'], year)).num_rows
+            _retry(lambda: write_deltalake(output, deduped, mode='overwrite',
+                                           predicate=partition_predicate(pair, year), partition_by=['pair', 'year'],
+                                           target_file_size=target_size), pair, year)
+            files = pair_files(DeltaTable(output), pair)
+            bytes_rewritten += pc.sum(files.filter(pc.equal(files['partition.year'], year))['size_bytes']).as_py()
+        del deduped
+    if layout == 'zorder':
+        optimized = _retry(lambda: DeltaTable(output).optimize.z_order(
+            ['date'], partition_filters=partition_filters(pair, year), target_size=target_size), pair, year)
+    elif layout == 'compact':
+        optimized = _retry(lambda: DeltaTable(output).optimize.compact(
+            partition_filters=partition_filters(pair, year), target_size=target_size), pair, year)
+    else:
+        optimized = None
+    if optimized is not None:
+        files_removed += optimized['numFilesRemoved']
+        if optimized['numFilesAdded'] > 0:
+            bytes_rewritten += json.loads(optimized['filesAdded'])['totalSize']
+    return dict(pair=pair, year=year, duplicates=duplicates, files_removed=files_removed,
+                bytes_rewritten=bytes_rewritten, missing_stats=date_stats_missing(DeltaTable(output), pair, year),
+                seconds=time.perf_counter() - start)
 
-def main():
+
+def sample_range(dt, sample=None):
+    """
+    (pair, start, end) of the range query used to measure the effect of the layout.
+    :param sample: 'PAIR,START,END' (FX_DATA_CLEAN_SAMPLE). Defaults to the first week of July in
+                   the largest partition.
+    """
+    if sample:
+        pair, start, end = sample.split(',')
+        return pair.upper(), datetime.fromisoformat(start), datetime.fromisoformat(end)
+    parts = partitions(dt)
+    if not parts:
+        return None
+    largest = max(parts, key=lambda p: p['size_bytes'])
+    return largest['pair'], datetime(largest['year'], 7, 1), datetime(largest['year'], 7, 8)
+
+
+def main(dedup=None, workers=None, memory_budget_mb=None, force=False, layout=None, target_file_mb=None,
+         sample=None):
+    """
+    Remove duplicates, then compact and vacuum the Delta table, one (pair, year) partition at a time.
+    Each partition is read, deduplicated, written back and compacted by a worker of a process pool
+    (FX_DATA_CLEAN_WORKERS). The partitions in flight are kept under a memory budget
+    (FX_DATA_CLEAN_MEMORY_MB), estimated from their size on disk.
+    Partitions whose files did not change since the last run are skipped, unless force=True.
+    Tables written by dt_download with write_mode='merge' have no duplicates, so dedup can be
+    skipped with dedup=False (or FX_DATA_CLEAN_DEDUP=0).
+    The file layout of each partition is set by layout (FX_DATA_CLEAN_LAYOUT, see clean_partition) with
+    files of target_file_mb (FX_DATA_CLEAN_TARGET_FILE_MB). The files and bytes a sample range query
+    (FX_DATA_CLEAN_SAMPLE=PAIR,START,END) has to read are logged before and after.
+    """
+    metrics.configure_from_env()
     output = os.environ.get("FX_DATA_OUTPUT", 'output')
+    dedup = os.environ.get("FX_DATA_CLEAN_DEDUP", '1') == '1' if dedup is None else dedup
+    workers = int(os.environ.get("FX_DATA_CLEAN_WORKERS", os.cpu_count() or 1)) if workers is None else workers
+    memory_budget_mb = int(os.environ.get("FX_DATA_CLEAN_MEMORY_MB", 2048)) if memory_budget_mb is None else memory_budget_mb
+    budget = memory_budget_mb << 20
+    layout = os.environ.get("FX_DATA_CLEAN_LAYOUT", 'compact') if layout is None else layout
+    if target_file_mb is None and os.environ.get("FX_DATA_CLEAN_TARGET_FILE_MB"):
+        target_file_mb = int(os.environ["FX_DATA_CLEAN_TARGET_FILE_MB"])
+    target_size = target_file_mb << 20 if target_file_mb else None
+    sample = os.environ.get("FX_DATA_CLEAN_SAMPLE") if sample is None else sample
+    if layout not in LAYOUTS:
+        raise ValueError(f'Unknown layout: {layout}')
+
     dt = DeltaTable(output)
-    partitions = pd.DataFrame(dt.partitions())
-    pairs = partitions.pair.unique()
-
-    # REMOVE DUPLICATES
-    for pair in pairs:
-        logger.info(f"Removing duplicates for {pair}")
-
-        df = dt.to_pandas(partitions=[('pair', '=', pair)])
-        df2 = df.drop_duplicates(subset=['date', 'pair']).reset_index(drop=True)
-
-        number_of_duplicates = df.shape[0] - df2.shape[0]
-        logger.info(f"  Found {number_of_duplicates} duplicates for {pair}.\nShape before: {df.shape}, after: {df2.shape}")
-
-        write_deltalake(
-            table_or_uri=dt,
-            data=df2,
-            mode='overwrite',
-            predicate=f"pair = '{pair}'",
-            partition_by=['pair', 'year'],
-        )
-
-        logger.info(f"  Removed duplicates for {pair}")
-
-    # Verify that there are no duplicates left
-    for pair in pairs:
-        df = dt.to_pandas(partitions=[('pair', '=', pair)])
-        duplicates = df.duplicated(subset=['date', 'pair']).sum()
-        if duplicates > 0:
-            logger.error(f"Error: Found {duplicates} duplicates for {pair} after cleanup!")
-        else:
-            logger.info(f"No duplicates found for {pair} after cleanup.")
-
-    # COMPACT DELTA TABLE
-    # We could compact in a single call, but I'm not sure how much memory it will use
-    for pair in pairs:
-        dt.optimize.compact(partition_filters=[('pair', '=', pair)])
-    dt.vacuum(retention_hours=0, enforce_retention_duration=False, dry_run=True)
-    dt.vacuum(retention_hours=0, enforce_retention_duration=False, dry_run=False)
-
-    
+    # A partition cleaned with one layout still has to be rewritten for another.
+    state_name = 'dt_clean' if layout == 'compact' else f'dt_clean_{layout}'
+    state = {} if force else load_state(output, state_name)
+    todo = [p for p in partitions(dt) if state.get(f"{p['pair']}/{p['year']}") != p['fingerprint']]
+    logger.info(f"{len(todo)} partitions to clean ({layout} layout), {workers} workers, "
+                f"memory budget {memory_budget_mb} MB")
+    query = sample_range(dt, sample)
+    before = scan_cost(dt, *query) if query else None
+
+    # Largest partitions first, so that the small ones fill the gaps at the end.
+    todo.sort(key=lambda p: p['size_bytes'], reverse=True)
+    reports = []
+    # deltalake's runtime does not survive a fork, the workers have to be spawned.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        running = {}
+        while todo or running:
+            in_use = sum(estimate for _, estimate in running.values())
+            for p in list(todo):
+                estimate = p['size_bytes'] * MEMORY_EXPANSION
+                if len(running) >= workers:
+                    break
+                # A single partition over budget still runs, but alone.
+                if running and in_use + estimate > budget:
+                    continue
+                future = executor.submit(clean_partition, output, p['pair'], p['year'], dedup, layout,
+                                         target_size)
+                running[future] = (p, estimate)
+                in_use += estimate
+                todo.remove(p)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                report = future.result()
+                reports.append(report)
+                metrics.record('clean_partition', report['seconds'], pair=report['pair'], year=report['year'],
+                               bytes=report['bytes_rewritten'], rows=report['duplicates'])
+                logger.info(f"  {report['pair']} {report['year']}: removed {report['duplicates']} duplicates, "
+                            f"compacted {report['files_removed']} files, rewrote {report['bytes_rewritten']} bytes "
+                            f"in {report['seconds']:.2f}s")
+                if report['missing_stats']:
+                    logger.warning(f"  {report['pair']} {report['year']}: {report['missing_stats']} files have no "
+                                   f"date statistics and cannot be skipped by range queries")
+
+    logger.info(f"Cleaned {len(reports)} partitions: {sum(r['duplicates'] for r in reports)} duplicates removed, "
+                f"{sum(r['bytes_rewritten'] for r in reports)} bytes rewritten")
+
+    dt = DeltaTable(output)
+    if query:
+        after = scan_cost(dt, *query)
+        pair, start, end = query
+        logger.info(f"Sample query {pair} [{start:%Y-%m-%d}, {end:%Y-%m-%d}): "
+                    f"{before['files']} files / {before['bytes']} bytes before, "
+                    f"{after['files']} files / {after['bytes']} bytes after")
+    # The files of the versions pinned by readers (see histdata.catalog) are kept.
+    retention_hours = catalog.vacuum_retention_hours(output)
+    with metrics.span('vacuum'):
+        dt.vacuum(retention_hours=retention_hours, enforce_retention_duration=False, dry_run=True)
+        dt.vacuum(retention_hours=retention_hours, enforce_retention_duration=False, dry_run=False)
+    state.update({f"{p['pair']}/{p['year']}": p['fingerprint'] for p in partitions(dt)})
+    save_state(output, state_name, state)
+    with metrics.span('checkpoint'):
+        catalog.checkpoint(output)
+    metrics.report()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,104 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from deltalake import DeltaTable, write_deltalake
+from histdata import metrics
+from histdata.delta import load_state, partition_filters, partition_predicate, partitions, save_state
+from histdata.features import WARMUP, WARMUP_BARS, compute
+from histdata.resample import PRICE_COLUMNS, read_partition
+
+from fx_logging import get_project_logger
+
+# Setup logging
+logger = get_project_logger(__name__)
+
+
+def read_warmup(dt, pair, year):
+    """
+    Bars of the previous year partition within WARMUP of the start of the year, sorted by date, or
+    its last WARMUP_BARS bars if that is more.
+    """
+    start = np.datetime64(f'{year}-01-01', 'us') - WARMUP
+    table = dt.to_pyarrow_table(partitions=partition_filters(pair, year - 1), columns=['date'] + PRICE_COLUMNS,
+                                filters=ds.field('date') >= pa.scalar(start, pa.timestamp('us')))
+    if table.num_rows < WARMUP_BARS:
+        # A gap in the data at the end of the year: the previous bars are further back.
+        table = dt.to_pyarrow_table(partitions=partition_filters(pair, year - 1), columns=['date'] + PRICE_COLUMNS)
+        table = table.sort_by('date')
+        table = table.slice(max(table.num_rows - WARMUP_BARS, 0))
+    table = table.sort_by('date')
+    seconds = table['date'].cast(pa.timestamp('s')).cast(pa.int64()).to_numpy()
+    return (seconds,) + tuple(table[c].to_numpy() for c in PRICE_COLUMNS)
+
+
+def feature_partition(output, pair, year, warmup):
+    """
+    Features of a single (pair, year) partition, and the seconds spent. Runs in a worker process.
+    :param warmup: Whether the previous year partition exists and warms the windows up.
+    """
+    start = time.perf_counter()
+    dt = DeltaTable(output)
+    bars = read_partition(dt, pair, year)
+    before = read_warmup(dt, pair, year) if warmup else tuple(np.empty(0) for _ in bars)
+    seconds, *prices = (np.concatenate(arrays) for arrays in zip(before, bars))
+    # Duplicated dates (in a table not cleaned yet by dt_clean) keep their first bar.
+    seconds, first = np.unique(seconds.astype(np.int64), return_index=True)
+    prices = [p[first] for p in prices]
+    table = compute(seconds, *prices, pair=pair, warmup=int(np.searchsorted(seconds, bars[0][0])) if len(bars[0]) else 0)
+    return table, time.perf_counter() - start
+
+
+def write_partition(table_uri, table, pair, year):
+    """
+    Replace the rows of a (pair, year) partition of the feature table.
+    """
+    if DeltaTable.is_deltatable(table_uri):
+        write_deltalake(table_uri, table, mode='overwrite', predicate=partition_predicate(pair, year),
+                        partition_by=['pair', 'year'])
+    else:
+        write_deltalake(table_uri, table, mode='append', partition_by=['pair', 'year'])
+
+
+def main(workers=None, force=False):
+    """
+    Materialize the rolling features of the M1 bars (see histdata.features) into the Delta table
+    FX_DATA_OUTPUT + '_features', partitioned like the M1 table. Partitions are computed in a process
+    pool (FX_DATA_FEATURE_WORKERS), each warmed up with the end of the previous year, so they are
+    independent. Only the partitions whose files changed since the last run are recomputed, with the
+    year after each of them (its windows reach back into it), unless force=True.
+    """
+    metrics.configure_from_env()
+    output = os.environ.get("FX_DATA_OUTPUT", 'output')
+    workers = int(os.environ.get("FX_DATA_FEATURE_WORKERS", os.cpu_count() or 1)) if workers is None else workers
+    features_uri = f"{output}_features"
+
+    state = {} if force else load_state(output, 'dt_features')
+    current = {(p['pair'], int(p['year'])): p for p in partitions(DeltaTable(output))}
+    changed = {key for key, p in current.items() if state.get(f"{key[0]}/{key[1]}") != p['fingerprint']}
+    todo = sorted(changed | {(pair, year + 1) for pair, year in changed if (pair, year + 1) in current})
+    logger.info(f"{len(todo)} partitions to compute, {workers} workers")
+
+    # deltalake's runtime does not survive a fork, the workers have to be spawned.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(feature_partition, output, pair, year, (pair, year - 1) in current): (pair, year)
+                   for pair, year in todo}
+        for future in as_completed(futures):
+            pair, year = futures[future]
+            table, seconds = future.result()
+            metrics.record('features', seconds, pair=pair, year=year, rows=table.num_rows)
+            # The results are written from this process only: Delta commits from the workers would conflict.
+            with metrics.span('features_write', pair=pair, year=year):
+                write_partition(features_uri, table, pair, year)
+            state[f"{pair}/{year}"] = current[(pair, year)]['fingerprint']
+            save_state(output, 'dt_features', state)
+            logger.info(f"  {pair} {year}: {table.num_rows} rows")
+    metrics.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pyarrow.compute as pc
+from deltalake import DeltaTable, write_deltalake
+from histdata import metrics
+from histdata.delta import last_date, load_state, partition_predicate, partitions, save_state
+from histdata.quality import scan
+from histdata.resample import read_partition
+
+from fx_logging import get_project_logger
+
+# Setup logging
+logger = get_project_logger(__name__)
+
+
+def scan_partition(output, pair, year, previous_year=None):
+    """
+    Quality summary and gaps of a single (pair, year) partition, and the seconds spent. Runs in a worker process.
+    :param previous_year: Year of the previous partition of the pair, if any: a gap from its last bar
+                          to the first bar of this partition is reported in this partition.
+    """
+    start = time.perf_counter()
+    dt = DeltaTable(output)
+    previous = last_date(dt, pair, previous_year) if previous_year is not None else None
+    previous = np.datetime64(previous, 's').astype(np.int64) if previous is not None else None
+    summary, gaps = scan(*read_partition(dt, pair, year), pair=pair, previous=previous)
+    return summary, gaps, time.perf_counter() - start
+
+
+def write_partition(table_uri, table, pair, year):
+    """
+    Replace the rows of a (pair, year) partition of a result table.
+    """
+    if DeltaTable.is_deltatable(table_uri):
+        write_deltalake(table_uri, table, mode='overwrite', predicate=partition_predicate(pair, year),
+                        partition_by=['pair'])
+    else:
+        write_deltalake(table_uri, table, mode='append', partition_by=['pair'])
+
+
+def main(workers=None, force=False):
+    """
+    Scan the M1 table for data quality issues, one (pair, year) partition at a time, in a process pool
+    (FX_DATA_QUALITY_WORKERS). The monthly summaries go to the Delta table FX_DATA_OUTPUT + '_quality'
+    and the gaps to FX_DATA_OUTPUT + '_quality_gaps'. Partitions whose files did not change since
+    the last scan are skipped, unless force=True. The partition following a changed one is scanned
+    again too, as a gap across the new year is reported with it.
+    """
+    metrics.configure_from_env()
+    output = os.environ.get("FX_DATA_OUTPUT", 'output')
+    workers = int(os.environ.get("FX_DATA_QUALITY_WORKERS", os.cpu_count() or 1)) if workers is None else workers
+    summary_uri, gaps_uri = f"{output}_quality", f"{output}_quality_gaps"
+
+    state = {} if force else load_state(output, 'dt_quality')
+    parts = partitions(DeltaTable(output))
+    # partitions() is sorted by pair and year: pair up each partition with the previous one of its pair.
+    following = {(before['pair'], before['year']): p for before, p in zip(parts, parts[1:]) if before['pair'] == p['pair']}
+    previous_year = {(p['pair'], p['year']): year for (_, year), p in following.items()}
+    todo = {}
+    for p in parts:
+        if state.get(f"{p['pair']}/{p['year']}") != p['fingerprint']:
+            todo[(p['pair'], p['year'])] = p
+            after = following.get((p['pair'], p['year']))
+            if after is not None:
+                todo[(after['pair'], after['year'])] = after
+    todo = list(todo.values())
+    logger.info(f"{len(todo)} partitions to scan, {workers} workers")
+
+    # deltalake's runtime does not survive a fork, the workers have to be spawned.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(scan_partition, output, p['pair'], p['year'],
+                                   previous_year.get((p['pair'], p['year']))): p for p in todo}
+        for future in as_completed(futures):
+            p = futures[future]
+            summary, gaps, seconds = future.result()
+            metrics.record('quality_scan', seconds, pair=p['pair'], year=p['year'],
+                           rows=pc.sum(summary['rows']).as_py())
+            # The results are written from this process only: Delta commits from the workers would conflict.
+            with metrics.span('quality_write', pair=p['pair'], year=p['year']):
+                write_partition(summary_uri, summary, p['pair'], p['year'])
+                write_partition(gaps_uri, gaps, p['pair'], p['year'])
+            state[f"{p['pair']}/{p['year']}"] = p['fingerprint']
+            save_state(output, 'dt_quality', state)
+            issues = {name: pc.sum(summary[name]).as_py() or 0
+                      for name in ('duplicates', 'gaps', 'ohlc_violations', 'non_positive', 'outliers')}
+            logger.info(f"  {p['pair']} {p['year']}: {pc.sum(summary['rows']).as_py() or 0} rows, "
+                        + ', '.join(f"{count} {name}" for name, count in issues.items()))
+    metrics.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+from deltalake import DeltaTable
+from histdata import metrics
+from histdata.delta import partitions
+from histdata.resample import materialize
+
+from fx_logging import get_project_logger
+
+# Setup logging
+logger = get_project_logger(__name__)
+
+
+def main():
+    """
+    Refresh the materialized higher timeframe tables (one Delta table per timeframe,
+    FX_DATA_OUTPUT suffixed with the timeframe, e.g. output_H1) from the M1 table.
+    Daily bars close at 17:00 New York time, intraday bars are aligned on EST.
+    """
+    metrics.configure_from_env()
+    output = os.environ.get("FX_DATA_OUTPUT", 'output')
+    timeframes = os.environ.get("FX_DATA_TIMEFRAMES", 'M5,M15,H1,D1').split(',')
+    pairs = sorted({p['pair'] for p in partitions(DeltaTable(output))})
+
+    for timeframe in timeframes:
+        session = 'new_york' if timeframe == 'D1' else 'est'
+        target = f"{output}_{timeframe}"
+        logger.info(f"Resampling {len(pairs)} pairs to {timeframe} into {target}")
+        for pair in pairs:
+            with metrics.span('resample', pair=pair, timeframe=timeframe) as span:
+                span.add(rows=materialize(output, target, pair, timeframe, session=session))
+    metrics.report()
+
+
+if __name__ == "__main__":
+    main()
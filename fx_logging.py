@@ -1,85 +1,4 @@
 """
-Shared logging configuration for FX data download project.
+Kept for the scripts importing it: the logging configuration lives in histdata.log.
 """
-import logging
-import sys
-import os
-from typing import Optional
-
-
-def setup_logger(
-    name: str = __name__,
-    level: int = logging.INFO,
-    log_file: Optional[str] = None,
-    console_output: bool = True
-) -> logging.Logger:
-    """
-    Setup a logger with consistent formatting across the project.
-    
-    Args:
-        name: Logger name (typically __name__)
-        level: Logging level (default: INFO)
-        log_file: Optional log file path
-        console_output: Whether to output to console (default: True)
-    
-    Returns:
-        Configured logger instance
-    """
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    
-    # Remove existing handlers to avoid duplicates
-    for handler in logger.handlers[:]:
-        logger.removeHandler(handler)
-    
-    # Create formatter
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    
-    # Console handler
-    if console_output:
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setLevel(level)
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
-    
-    # File handler
-    if log_file:
-        # Create logs directory if it doesn't exist
-        log_dir = os.path.dirname(log_file) if os.path.dirname(log_file) else 'logs'
-        if log_dir and not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-            
-        file_handler = logging.FileHandler(log_file)
-        file_handler.setLevel(logging.DEBUG)  # More detailed logging to file
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-    
-    return logger
-
-
-def get_project_logger(module_name: str) -> logging.Logger:
-    """
-    Get a logger with standard project configuration.
-    
-    Args:
-        module_name: Name of the module (typically __name__)
-    
-    Returns:
-        Configured logger instance
-    """
-    # Create logs directory if it doesn't exist
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
-    
-    # Generate log file name based on module
-    log_file = f"logs/{module_name.replace('.', '_')}.log"
-    
-    return setup_logger(
-        name=module_name,
-        level=logging.INFO,
-        log_file=log_file,
-        console_output=True
-    )
+from histdata.log import DATE_FORMAT, FORMAT, get_project_logger, setup_logger, shutdown  # noqa: F401
@@ -1,3 +1,27 @@
-from histdata.api import download_hist_data
+"""
+Download and read FX/commodities data (M1, Tick) from histdata.com.
+
+The public functions are imported on first access, so `import histdata` stays cheap:
+download_hist_data only needs requests, while load and iter_batches bring in pyarrow and deltalake.
+"""
+import importlib
 
 __version__ = '1.0'
+
+_EXPORTS = {'download_hist_data': 'histdata.api',
+            'load': 'histdata.query',
+            'iter_batches': 'histdata.query'}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module(_EXPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module 'histdata' has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
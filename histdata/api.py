@@ -1,27 +1,48 @@
+"""
+Download of histdata.com archives.
+
+Only requests is needed to fetch the ZIP archives. pandas, pyarrow and deltalake are imported
+when an archive is written to a Delta table or to Parquet, so a plain download stays cheap to import.
+"""
 import os
-import sys
+import re
+import shutil
+import tempfile
+import threading
+import time
 from datetime import datetime
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 # ========================================================================
-from deltalake import write_deltalake
 from zipfile import ZipFile
-from typing import Union
-import pandas as pd
-import io
+from typing import TYPE_CHECKING, Union
+
+from histdata import metrics
+from histdata.cache import get_default_cache, period_name
+from histdata.log import get_project_logger
 
-# Add parent directory to path to import fx_logging
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from fx_logging import get_project_logger
+if TYPE_CHECKING:
+    import pandas as pd
 
 # Setup logging
 logger = get_project_logger(__name__)
 
 COL_NAMES = ['date', 'open', 'high', 'low', 'close', 'volume']
+SPOOL_CHUNK_SIZE = 1 << 20
+
+
+class NoArchiveError(AssertionError):
+    """
+    histdata.com has no archive for the requested pair and period.
+    An AssertionError, as download_hist_data has always raised for a missing archive.
+    """
+
+
+def extract_data(file, col_names = COL_NAMES) -> 'Union[pd.DataFrame, None]':
+    import pandas as pd
 
-def extract_data(file, col_names = COL_NAMES) -> Union[pd.DataFrame, None]:
     with ZipFile(file, 'r') as zip:
         for f in zip.namelist():
             if '.csv' in f:
@@ -87,6 +108,195 @@ def get_referer(referer_prefix, pair, year, month):
     return referer_prefix + '{}/{}'.format(pair.lower(), year)
 
 
+HISTDATA_URL = 'https://www.histdata.com'
+
+_TK_INPUT = re.compile(rb'<input\b[^>]*\bid\s*=\s*["\']?tk["\'\s>][^>]*>', re.IGNORECASE)
+_VALUE_ATTR = re.compile(rb'\bvalue\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
+
+
+def extract_token(content):
+    """
+    Extract the value of the <input id="tk"> field from the referer page.
+    Only the matching tag is looked at, the rest of the page is never parsed.
+    :param content: Raw page content (bytes).
+    :return: The token, or None if the page has no token.
+    """
+    match = _TK_INPUT.search(content)
+    if match is None:
+        return None
+    value = _VALUE_ATTR.search(match.group(0))
+    if value is None:
+        return None
+    token = next(g for g in value.groups() if g is not None)
+    return token.decode('utf-8', errors='replace') or None
+
+
+class HistDataClient:
+    """
+    Talks to histdata.com over a pooled keep-alive session.
+    One client can be shared between threads, so all downloads reuse the same connections.
+    """
+
+    TOKEN_TTL = 300  # seconds a token scraped from a referer page is reused.
+
+    def __init__(self, transport=None, base_url=HISTDATA_URL, pool_size=16):
+        """
+        :param transport: Object exposing requests' get/post interface. Defaults to a pooled Session.
+        :param base_url: Where histdata.com lives. Point it to a local stand-in server for benchmarks.
+        :param pool_size: Max number of keep-alive connections kept to the host.
+        """
+        if transport is None:
+            transport = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            transport.mount('https://', adapter)
+            transport.mount('http://', adapter)
+        self.transport = transport
+        self.base_url = base_url.rstrip('/')
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def referer(self, year, month, pair, time_frame, platform):
+        prefix_referer = get_prefix_referer(time_frame, platform).replace(HISTDATA_URL, self.base_url, 1)
+        return get_referer(prefix_referer, pair.lower(), year, month)
+
+    def get_token(self, referer, transport=None, verify=False):
+        """
+        Fetch the referer page and return its token. Tokens are cached per referer
+        for TOKEN_TTL seconds so that retries do not fetch the page again.
+        """
+        with self._lock:
+            cached = self._tokens.get(referer)
+        if cached is not None and time.monotonic() - cached[1] < self.TOKEN_TTL:
+            return cached[0]
+
+        with metrics.span('token_get') as span:
+            r1 = (transport or self.transport).get(referer, allow_redirects=True, verify=verify)
+            span.add(bytes=len(r1.content))
+        assert r1.status_code == 200, 'Make sure the website www.histdata.com is up.'
+        with metrics.span('token_parse'):
+            token = extract_token(r1.content)
+        if token is None:
+            raise NoArchiveError('There is no token. Please make sure your year/month/pair is correct.'
+                                 'Example is year=2016, month=7, pair=eurgbp')
+        with self._lock:
+            self._tokens[referer] = (token, time.monotonic())
+        return token
+
+    def forget_token(self, referer):
+        with self._lock:
+            self._tokens.pop(referer, None)
+
+    def download(self, year, month, pair, time_frame, platform, transport=None, verify=False, stream=False):
+        """
+        Request one archive from histdata.com.
+        :param transport: Overrides the client's transport for this call.
+        :param stream: Do not read the body upfront (see requests' stream argument).
+        :return: The requests.Response of the POST to get.php.
+        """
+        referer = self.referer(year, month, pair, time_frame, platform)
+
+        # Referer is the most important thing here.
+        headers = {'Host': 'www.histdata.com',
+                   'Connection': 'keep-alive',
+                   'Content-Length': '104',
+                   'Cache-Control': 'max-age=0',
+                   'Origin': 'https://www.histdata.com',
+                   'Upgrade-Insecure-Requests': '1',
+                   'Content-Type': 'application/x-www-form-urlencoded',
+                   'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+                   'Referer': referer}
+
+        token = self.get_token(referer, transport=transport, verify=verify)
+
+        data = {'tk': token,
+                'date': str(year),
+                'datemonth': '{}{}'.format(year, str(month).zfill(2)) if month is not None else str(year),
+                'platform': platform,
+                'timeframe': time_frame,
+                'fxpair': pair.upper()}
+        logger.debug("Download request data: %s", data)
+        with metrics.span('post') as span:
+            r = (transport or self.transport).post(url=self.base_url + '/get.php',
+                                                   data=data,
+                                                   headers=headers, verify=verify, stream=stream)
+            if not stream:
+                span.add(bytes=len(r.content))
+        # Any response consumes the token. Only a failed connection keeps it for the retry.
+        self.forget_token(referer)
+        return r
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HistDataClient()
+        return _default_client
+
+
+def get_period(year, month):
+    """
+    First instant of the period and first instant after it.
+    """
+    year = int(year)
+    if month is None:
+        return datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    month = int(month)
+    return datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def spool_response(r, chunk_size=SPOOL_CHUNK_SIZE):
+    """
+    Copy a streamed requests.Response to an anonymous temporary file.
+    :return: The file, positioned at the start, and the number of bytes written.
+    """
+    f = tempfile.TemporaryFile()
+    size = 0
+    for chunk in r.iter_content(chunk_size=chunk_size):
+        if chunk:
+            f.write(chunk)
+            size += len(chunk)
+    f.seek(0)
+    return f, size
+
+
+def _open_archive(year, month, pair, time_frame, platform, period, verbose, verify, client, cache):
+    """
+    Binary file of the archive, from the cache or downloaded (and then cached).
+    """
+    cache = get_default_cache() if cache is None else cache or None
+    if cache is not None:
+        with metrics.span('cache_get') as span:
+            archive = cache.get(platform, pair, time_frame, period)
+            span.add(hits=archive is not None)
+        if archive is not None:
+            if verbose:
+                logger.info(f"Using cached archive {archive}")
+            return open(archive, 'rb')
+        if cache.offline:
+            raise AssertionError(f'No cached archive for {pair} {period} and the cache is offline.')
+
+    client = client or get_default_client()
+    if verbose:
+        logger.info(f"Requesting data from: {client.referer(year, month, pair, time_frame, platform)}")
+    r = client.download(year, month, pair, time_frame, platform, verify=verify, stream=True)
+    with metrics.span('spool') as span:
+        archive, size = spool_response(r)
+        span.add(bytes=size)
+    if size == 0:
+        archive.close()
+        raise NoArchiveError('No data could be found here.')
+    if cache is not None:
+        with archive, metrics.span('cache_put') as span:
+            span.add(bytes=size)
+            return open(cache.put(platform, pair, time_frame, period, archive), 'rb')
+    return archive
+
+
 def download_hist_data(year='2016',
                        month=None,
                        pair='eurusd',
@@ -96,6 +306,13 @@ def download_hist_data(year='2016',
                        verbose=True,
                        verify=False,
                        delta_lake=False,
+                       client=None,
+                       stream=False,
+                       write_mode='append',
+                       bars_directory=None,
+                       cache=None,
+                       output_format='zip',
+                       price_type='float64',
                        ):
     """
     Download 1-Minute FX data per month.
@@ -105,14 +322,26 @@ def download_hist_data(year='2016',
     :param time_frame: M1 (one minute) or T (tick data)
     :param platform: MT, ASCII, XLSX, NT, MS
     :param output_directory: Where to dump the data.
-    :return: ZIP Filename.
+    :param client: HistDataClient to use. Defaults to a shared client with a pooled session.
+    :param stream: With delta_lake=True, write the archive to the Delta table in record batches
+                   instead of loading it with pandas.
+    :param write_mode: With delta_lake=True, 'append' or 'merge' (upsert keyed on pair and date).
+    :param bars_directory: With delta_lake=True and tick data, the Delta table receiving the bid/ask/mid
+                           and spread M1 bars built from the ticks. Defaults to output_directory + '_bars'.
+    :param cache: ArchiveCache the archive is read from / stored in. Defaults to the cache configured
+                  by FX_DATA_CACHE, if any. Pass False to bypass it.
+    :param output_format: Without delta_lake, 'zip' keeps the archive as downloaded, 'parquet' writes a
+                          typed Parquet file (see histdata.parquet) instead. Needs the ASCII platform.
+    :param price_type: With output_format='parquet', 'float64' or 'float32' prices.
+    :return: ZIP (or Parquet) Filename.
     """
-    if month is None:
-        output_filename = 'DAT_{}_{}_{}_{}.zip'.format(platform, pair.upper(), time_frame, str(year))
-    else:
-        output_filename = 'DAT_{}_{}_{}_{}.zip'.format(platform, pair.upper(), time_frame,
-                                                       '{}{}'.format(year, str(month).zfill(2)))
-    output_filename = os.path.join(output_directory, output_filename)
+    period = period_name(year, month)
+    if output_format not in ('zip', 'parquet'):
+        raise ValueError(f'Unknown output format: {output_format}')
+    if output_format == 'parquet' and platform != Platform.GENERIC_ASCII:
+        raise ValueError('Parquet output is only available for the ASCII platform.')
+    output_filename = os.path.join(output_directory, 'DAT_{}_{}_{}_{}.{}'.format(platform, pair.upper(),
+                                                                              time_frame, period, output_format))
 
     if os.path.exists(output_filename):
         if verbose:
@@ -126,67 +355,56 @@ def download_hist_data(year='2016',
         msg += 'For the past years, please query per year with month=None.'
         raise AssertionError(msg)
 
-    prefix_referer = get_prefix_referer(time_frame, platform)
-    referer = get_referer(prefix_referer, pair.lower(), year, month)
-
-    # Referer is the most important thing here.
-    headers = {'Host': 'www.histdata.com',
-               'Connection': 'keep-alive',
-               'Content-Length': '104',
-               'Cache-Control': 'max-age=0',
-               'Origin': 'https://www.histdata.com',
-               'Upgrade-Insecure-Requests': '1',
-               'Content-Type': 'application/x-www-form-urlencoded',
-               'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-               'Referer': referer}
-
-    if verbose:
-        logger.info(f"Requesting data from: {referer}")
-    r1 = requests.get(referer, allow_redirects=True, verify=verify)
-    assert r1.status_code == 200, 'Make sure the website www.histdata.com is up.'
-
-    soup = BeautifulSoup(r1.content, 'html.parser')
-    try:
-        token = soup.find('input', {'id': 'tk'}).attrs['value']
-        assert len(token) > 0
-    except:
-        raise AssertionError('There is no token. Please make sure your year/month/pair is correct.'
-                             'Example is year=2016, month=7, pair=eurgbp')
-
-    data = {'tk': token,
-            'date': str(year),
-            'datemonth': '{}{}'.format(year, str(month).zfill(2)) if month is not None else str(year),
-            'platform': platform,
-            'timeframe': time_frame,
-            'fxpair': pair.upper()}
-    r = requests.post(url='https://www.histdata.com/get.php',
-                      data=data,
-                      headers=headers, verify=verify)
-
-    assert len(r.content) > 0, 'No data could be found here.'
-    if verbose:
-        logger.debug(f"Download request data: {data}")
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
-    if delta_lake:
-
-        df = extract_data(io.BytesIO(r.content))
-        if df is None:
-            return None
+    with metrics.span('download', pair=pair.upper(), time_frame=time_frame, period=period):
+        archive = _open_archive(year, month, pair, time_frame, platform, period, verbose, verify, client, cache)
+        with archive:
+            if delta_lake and tick_data:
+                from histdata.ticks import ingest_ticks
+
+                # Tick months are too large for pandas, they always go through the streaming path.
+                with metrics.span('tick_ingest') as span:
+                    ticks, _ = ingest_ticks(archive, pair, time_frame, output_directory,
+                                            bars_directory or output_directory.rstrip('/\\') + '_bars',
+                                            period=get_period(year, month), write_mode=write_mode)
+                    span.add(rows=ticks)
+            elif delta_lake and stream:
+                from histdata.ingest import m1_reader, write_delta
+
+                with metrics.span('delta_write'):
+                    write_delta(output_directory, m1_reader(archive, pair), pair, year, mode=write_mode)
+            elif delta_lake:
+                import pandas as pd
+                from histdata.ingest import M1_TIMESTAMP_FORMAT, write_delta
+
+                with metrics.span('parse') as span:
+                    df = extract_data(archive)
+                    if df is None:
+                        return None
+
+                    df.drop(columns=['volume'], inplace=True)
+                    df.date = pd.to_datetime(df.date, format=M1_TIMESTAMP_FORMAT)
+                    df['year'] = df.date.dt.year
+                    df['pair'] = pair.upper()
+                    span.add(rows=len(df))
+
+                with metrics.span('delta_write') as span:
+                    span.add(rows=len(df))
+                    write_delta(output_directory, df, pair, year, mode=write_mode)
+            else:
+                if not os.path.exists(output_directory):
+                    os.makedirs(output_directory)
+                if output_format == 'parquet':
+                    from histdata.parquet import write_parquet
+                    from histdata.recompress import replace_atomically
+
+                    with metrics.span('parquet_write') as span:
+                        span.add(rows=replace_atomically(
+                            output_filename, lambda tmp: write_parquet(archive, tmp, pair, time_frame, price_type)))
+                else:
+                    with metrics.span('zip_write'):
+                        with open(output_filename, 'wb') as f:
+                            shutil.copyfileobj(archive, f)
 
-        df.drop(columns=['volume'], inplace=True)
-        df.date = pd.to_datetime(df.date)
-        df['year'] = df.date.dt.year
-        df['pair'] = pair.upper()  
-
-        write_deltalake(output_directory, df, mode='append', partition_by=['pair', 'year'])
-    else:
-        with open(output_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-    
     if verbose:
         logger.info(f'Wrote to {output_filename}')
     return output_filename
@@ -0,0 +1,247 @@
+"""
+Append-only binary store of M1 bars, one file per pair, read through np.memmap.
+
+Looking up the bars around a timestamp in the Delta table means decoding a Parquet file. Here a
+pair is a flat array of fixed-width records (int64 EST epoch minute, float32 open, high, low,
+close) behind a small header, so readers map the file and get zero-copy NumPy views of it, shared
+through the page cache by every process reading the same pair.
+
+    {root}/{PAIR}.bars  header (magic, record count) followed by the records, sorted by minute
+    {root}/{PAIR}.days  sparse index: (day, index of its first record) for every day with bars
+
+A lookup narrows the search to one day with the day index, then binary searches the minutes of
+that day. The store only grows: new bars are appended after the last stored minute, and the record
+count in the header is updated last, so readers never see a partially written record and a crashed
+append is rolled back by the next one. There must be a single writer per pair.
+"""
+import io
+import os
+
+import numpy as np
+
+from histdata.cache import period_end
+from histdata.log import get_project_logger
+
+logger = get_project_logger(__name__)
+
+MAGIC = b'FXBARS01'
+HEADER = np.dtype([('magic', 'S8'), ('count', '<i8'), ('reserved', '<i8', (2,))])
+RECORD = np.dtype([('minute', '<i8'), ('open', '<f4'), ('high', '<f4'), ('low', '<f4'), ('close', '<f4')])
+DAY_ENTRY = np.dtype([('day', '<i8'), ('index', '<i8')])
+
+MINUTES_PER_DAY = 1440
+
+
+def to_minute(value):
+    """
+    EST epoch minute of a timestamp (datetime, np.datetime64, ISO string) or of an int minute.
+    """
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return int(np.datetime64(value, 'm').astype(np.int64))
+
+
+def _read_header(path):
+    header = np.fromfile(path, dtype=HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] != MAGIC:
+        raise ValueError(f'{path} is not a bar store file.')
+    return int(header['count'][0])
+
+
+class PairBars:
+    """
+    Read-only view of the bars of one pair. The arrays are memory mapped: slicing them copies nothing.
+    Call refresh() to see the bars appended since the file was opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        count = _read_header(self.path + '.bars') if os.path.exists(self.path + '.bars') else 0
+        if count:
+            self.records = np.memmap(self.path + '.bars', dtype=RECORD, mode='r', offset=HEADER.itemsize,
+                                     shape=(count,))
+        else:
+            self.records = np.empty(0, dtype=RECORD)
+        days = np.fromfile(self.path + '.days', dtype=DAY_ENTRY) if count else np.empty(0, dtype=DAY_ENTRY)
+        # Entries past the record count belong to an append that did not complete.
+        days = days[days['index'] < count]
+        self.days = days['day']
+        self.day_starts = np.append(days['index'], count)
+        return self
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def minute(self):
+        return self.records['minute']
+
+    @property
+    def open(self):
+        return self.records['open']
+
+    @property
+    def high(self):
+        return self.records['high']
+
+    @property
+    def low(self):
+        return self.records['low']
+
+    @property
+    def close(self):
+        return self.records['close']
+
+    @property
+    def last_minute(self):
+        return int(self.records['minute'][-1]) if len(self.records) else None
+
+    def locate(self, timestamp, side='left'):
+        """
+        Index where a bar at `timestamp` is or would be inserted, as np.searchsorted(minute, ..., side).
+        """
+        minute = to_minute(timestamp)
+        day = np.searchsorted(self.days, minute // MINUTES_PER_DAY, side='right') - 1
+        if day < 0:
+            return 0
+        lo, hi = self.day_starts[day], self.day_starts[day + 1]
+        return int(lo + np.searchsorted(self.records['minute'][lo:hi], minute, side=side))
+
+    def between(self, start=None, end=None):
+        """
+        Records with start <= minute < end (either bound can be None).
+        """
+        lo = 0 if start is None else self.locate(start)
+        hi = len(self.records) if end is None else self.locate(end)
+        return self.records[lo:hi]
+
+    def around(self, timestamp, before=0, after=0):
+        """
+        The bar at `timestamp` (or the first bar after it), with `before` bars before and `after` bars after it.
+        """
+        index = self.locate(timestamp)
+        return self.records[max(index - before, 0):index + after + 1]
+
+
+class BarStore:
+    """
+    Directory of per-pair bar files.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, pair):
+        return os.path.join(self.root, pair.upper())
+
+    def pairs(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[:-len('.bars')] for name in os.listdir(self.root) if name.endswith('.bars'))
+
+    def open(self, pair):
+        return PairBars(self.path(pair))
+
+    def append(self, pair, minutes, open, high, low, close):
+        """
+        Append the bars later than the last stored minute. Duplicated minutes keep their first bar.
+        :param minutes: int64 EST epoch minutes.
+        :return: Number of bars appended.
+        """
+        path = self.path(pair)
+        os.makedirs(self.root, exist_ok=True)
+        if not os.path.exists(path + '.bars'):
+            header = np.zeros(1, dtype=HEADER)
+            header['magic'] = MAGIC
+            header.tofile(path + '.bars')
+            io.open(path + '.days', 'wb').close()
+        count = _read_header(path + '.bars')
+        current = PairBars(path)
+
+        minutes = np.asarray(minutes, dtype=np.int64)
+        minutes, first = np.unique(minutes, return_index=True)
+        keep = slice(None) if current.last_minute is None else minutes > current.last_minute
+        minutes, first = minutes[keep], first[keep]
+        if len(minutes) == 0:
+            return 0
+        records = np.empty(len(minutes), dtype=RECORD)
+        records['minute'] = minutes
+        for name, values in (('open', open), ('high', high), ('low', low), ('close', close)):
+            records[name] = np.asarray(values)[first]
+
+        days = minutes // MINUTES_PER_DAY
+        new_day = np.concatenate(([len(current.days) == 0 or days[0] != current.days[-1]], days[1:] != days[:-1]))
+        entries = np.empty(int(new_day.sum()), dtype=DAY_ENTRY)
+        entries['day'] = days[new_day]
+        entries['index'] = count + np.flatnonzero(new_day)
+
+        # Drop what a crashed append may have left after the committed records, then append.
+        for suffix, data, size in (('.bars', records, HEADER.itemsize + count * RECORD.itemsize),
+                                   ('.days', entries, len(current.days) * DAY_ENTRY.itemsize)):
+            with io.open(path + suffix, 'r+b') as f:
+                f.truncate(size)
+                f.seek(size)
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        with io.open(path + '.bars', 'r+b') as f:
+            f.seek(HEADER.fields['count'][1])
+            f.write(np.int64(count + len(records)).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return len(records)
+
+    def export_delta(self, table_uri, pair):
+        """
+        Append the bars of a pair from the Delta table of M1 bars, starting with the year of the last stored bar.
+        :return: Number of bars appended.
+        """
+        from deltalake import DeltaTable
+        from histdata.resample import read_partition, years
+
+        dt = DeltaTable(table_uri)
+        last = self.open(pair).last_minute
+        first_year = None if last is None else int(np.datetime64(last, 'm').astype('datetime64[Y]').astype(int)) + 1970
+        appended = 0
+        for year in years(dt, pair.upper(), first_year):
+            seconds, *prices = read_partition(dt, pair.upper(), year)
+            appended += self.append(pair, seconds // 60, *prices)
+        logger.info(f"Appended {appended} bars of {pair.upper()} from {table_uri}")
+        return appended
+
+    def export_archives(self, root, pair=None):
+        """
+        Append the bars of the DAT_ASCII_*_M1_*.zip archives under root, in period order. Archives ending
+        before the last stored bar of their pair are not read.
+        :param pair: Only export this pair.
+        :return: Number of bars appended, per pair.
+        """
+        import pyarrow as pa
+        from histdata.ingest import m1_batches
+        from histdata.recompress import find_archives, parse_archive_name
+
+        by_pair = {}
+        for path in find_archives(root):
+            fields = parse_archive_name(path)
+            if fields['platform'] == 'ASCII' and fields['time_frame'] == 'M1' and \
+                    (pair is None or fields['pair'] == pair.upper()):
+                by_pair.setdefault(fields['pair'], []).append((fields['period'], path))
+
+        appended = {}
+        for name, archives in sorted(by_pair.items()):
+            appended[name] = 0
+            for period, path in sorted(archives, key=lambda a: (a[0][:4], a[0][4:])):
+                last = self.open(name).last_minute
+                if last is not None and to_minute(period_end(period)) <= last:
+                    continue
+                table = pa.Table.from_batches(list(m1_batches(path, name)))
+                if table.num_rows == 0:
+                    continue
+                table = table.sort_by('date')
+                minutes = table['date'].cast(pa.timestamp('s')).cast(pa.int64()).to_numpy() // 60
+                appended[name] += self.append(name, minutes, *(table[c].to_numpy() for c in ('open', 'high', 'low', 'close')))
+            logger.info(f"Appended {appended[name]} bars of {name} from {root}")
+        return appended
@@ -0,0 +1,193 @@
+"""
+Local cache of the raw archives downloaded from histdata.com.
+
+Archives are stored by content (objects/<sha256>.zip) and indexed in a small SQLite database
+by (platform, pair, time_frame, period), with their hash, size and fetch/access times.
+Past periods never change on histdata.com, so an archive fetched after the end of its period is
+never fetched again. One fetched before (the current month, or this year for a yearly query, may
+still be partial) is refetched when its entry is older than max_age, even once the period is over;
+if the new archive has the same hash, only the index is updated.
+The cache is kept under max_bytes by evicting the least recently used archives.
+"""
+import contextlib
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archives (
+    platform TEXT NOT NULL,
+    pair TEXT NOT NULL,
+    time_frame TEXT NOT NULL,
+    period TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (platform, pair, time_frame, period)
+)
+'''
+
+
+def period_name(year, month=None):
+    """
+    Period string as used in the archive names: '2016' or '201607'.
+    """
+    return str(year) if month is None else '{}{}'.format(year, str(month).zfill(2))
+
+
+def period_end(period):
+    """
+    End of a period ('2016' or '201607'): the start of the next year or month, in local time.
+    """
+    year = int(period[:4])
+    if len(period) == 4:
+        return datetime(year + 1, 1, 1)
+    month = int(period[4:])
+    return datetime(year + month // 12, month % 12 + 1, 1)
+
+
+class ArchiveCache:
+
+    def __init__(self, root, max_bytes=None, max_age=3600, offline=False):
+        """
+        :param root: Cache directory.
+        :param max_bytes: Evict least recently used archives above this total size (None: unbounded).
+        :param max_age: Seconds after which an archive of a period still in progress is refetched.
+        :param offline: Serve whatever is cached, even stale, and never go to the network.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.offline = offline
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        with self._db() as db:
+            db.execute(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _db(self):
+        db = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, 'objects', sha256[:2], sha256 + '.zip')
+
+    def get(self, platform, pair, time_frame, period):
+        """
+        Path of the cached archive, or None if it has to be (re)fetched.
+        """
+        key = (platform, pair.upper(), time_frame, str(period))
+        with self._db() as db:
+            row = db.execute('SELECT sha256, fetched_at FROM archives '
+                             'WHERE platform = ? AND pair = ? AND time_frame = ? AND period = ?', key).fetchone()
+            if row is None:
+                return None
+            sha256, fetched_at = row
+            path = self.object_path(sha256)
+            if not os.path.exists(path):
+                return None
+            # An archive fetched while its period was in progress may be partial, even if the period is over now.
+            final = fetched_at >= period_end(key[3]).timestamp()
+            if not (self.offline or final or time.time() - fetched_at < self.max_age):
+                return None
+            db.execute('UPDATE archives SET accessed_at = ? '
+                       'WHERE platform = ? AND pair = ? AND time_frame = ? AND period = ?', (time.time(),) + key)
+        return path
+
+    def put(self, platform, pair, time_frame, period, file):
+        """
+        Store an archive read from a binary file object.
+        :return: Path of the cached archive.
+        """
+        key = (platform, pair.upper(), time_frame, str(period))
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, 'objects'), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            path = self.object_path(digest.hexdigest())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(tmp)  # Same content already cached (e.g. revalidation found no change).
+            else:
+                os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        now = time.time()
+        with self._db() as db:
+            db.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       key + (digest.hexdigest(), size, now, now))
+        self.evict(keep=key)
+        return path
+
+    def size(self):
+        with self._db() as db:
+            return db.execute('SELECT COALESCE(SUM(size), 0) FROM '
+                              '(SELECT DISTINCT sha256, size FROM archives)').fetchone()[0]
+
+    def evict(self, keep=None):
+        """
+        Drop least recently used entries until the cache fits in max_bytes.
+        :param keep: (platform, pair, time_frame, period) of an entry never dropped, the one just stored:
+                     an archive alone over max_bytes is still served once.
+        """
+        if self.max_bytes is None:
+            return
+        total = self.size()
+        with self._db() as db:
+            rows = db.execute('SELECT platform, pair, time_frame, period, sha256, size FROM archives '
+                              'ORDER BY accessed_at').fetchall()
+            for platform, pair, time_frame, period, sha256, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if (platform, pair, time_frame, period) == keep:
+                    continue
+                db.execute('DELETE FROM archives WHERE platform = ? AND pair = ? AND time_frame = ? AND period = ?',
+                           (platform, pair, time_frame, period))
+                if db.execute('SELECT 1 FROM archives WHERE sha256 = ?', (sha256,)).fetchone() is None:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.object_path(sha256))
+                    total -= size
+
+
+_default_cache = None
+_default_cache_config = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Cache configured by the environment, or None. The same cache is returned until the environment
+    changes.
+    FX_DATA_CACHE: cache directory (no cache if unset).
+    FX_DATA_CACHE_MAX_MB: size bound of the cache.
+    FX_DATA_OFFLINE=1: only use the cache, never the network.
+    """
+    global _default_cache, _default_cache_config
+    root = os.environ.get('FX_DATA_CACHE')
+    if not root:
+        return None
+    max_mb = os.environ.get('FX_DATA_CACHE_MAX_MB')
+    config = (root, max_mb, os.environ.get('FX_DATA_OFFLINE', '0') == '1')
+    with _default_cache_lock:
+        if _default_cache is None or _default_cache_config != config:
+            _default_cache = ArchiveCache(root,
+                                          max_bytes=int(max_mb) << 20 if max_mb else None,
+                                          offline=config[2])
+            _default_cache_config = config
+        return _default_cache
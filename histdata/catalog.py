@@ -0,0 +1,307 @@
+"""
+Catalog of the Delta tables: checkpoints, cached file manifests and pinned versions.
+
+Opening a Delta table replays its transaction log from the last checkpoint, and listing its files
+(get_add_actions) materializes every add action with its statistics. With one commit per downloaded
+month, both get slow long before deltalake writes a checkpoint on its own. Here:
+
+- checkpoint() writes a checkpoint once FX_DATA_CHECKPOINT_EVERY commits piled up since the last
+  one, so the log is replayed from a recent checkpoint. The ingest jobs call it after writing.
+- manifest() caches the file list of a table version (paths, sizes, partition values, min/max
+  statistics) in memory and, for the versions pinned or opened as snapshots, as an Arrow IPC file
+  under {table}/_fx_state/manifests/, read back memory-mapped. A version never changes, so the cache
+  never needs invalidating. histdata.delta reads the file list of a table through it; the versions
+  a job goes through while writing are never written to disk.
+- pin() records a version under a name, so a set of readers (or a whole research run) reads the
+  same consistent snapshot while the jobs keep writing. snapshot() opens it: partition pruning and
+  the file list come from the cached manifest, and the data files are read directly by pyarrow.
+  vacuum_retention_hours() keeps the files of the pinned versions from being vacuumed.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from histdata.delta import STATE_DIR
+from histdata.log import get_project_logger
+
+logger = get_project_logger(__name__)
+
+MANIFEST_DIR = os.path.join(STATE_DIR, 'manifests')
+PINS = os.path.join(STATE_DIR, 'pins.json')
+# Manifests kept on disk besides those of the pinned versions, and in memory (least recently used first out).
+KEEP_MANIFESTS = 16
+
+_manifests = OrderedDict()
+_lock = threading.Lock()
+
+
+def local_path(dt_or_uri):
+    """
+    Local directory of a table (DeltaTable or URI), or None for a remote table.
+    """
+    uri = dt_or_uri if isinstance(dt_or_uri, (str, os.PathLike)) else dt_or_uri.table_uri
+    uri = os.fspath(uri)
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    return None if '://' in uri else uri.rstrip('/')
+
+
+def last_checkpoint(uri):
+    """
+    Version of the last checkpoint of the table, or None.
+    """
+    path = os.path.join(local_path(uri), '_delta_log', '_last_checkpoint')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)['version']
+
+
+def checkpoint(uri, every=None):
+    """
+    Write a checkpoint if `every` commits (FX_DATA_CHECKPOINT_EVERY, default 100) were made since the last one.
+    :return: Whether a checkpoint was written.
+    """
+    from deltalake import DeltaTable
+
+    every = int(os.environ.get("FX_DATA_CHECKPOINT_EVERY", 100)) if every is None else every
+    if not DeltaTable.is_deltatable(uri):
+        return False
+    dt = DeltaTable(uri)
+    last = last_checkpoint(uri)
+    if dt.version() - (-1 if last is None else last) < every:
+        return False
+    dt.create_checkpoint()
+    logger.info(f"Checkpoint of {uri} at version {dt.version()}")
+    return True
+
+
+def _manifest_path(root, version):
+    return os.path.join(root, MANIFEST_DIR, f'{version:020d}.arrow')
+
+
+def _read_manifest(path):
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _write_manifest(root, version, table):
+    path = _manifest_path(root, version)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Worker processes (dt_clean) may write the same manifest at the same time.
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with pa.OSFile(tmp, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+    keep = set(pins(root).values())
+    names = sorted(n for n in os.listdir(os.path.dirname(path)) if n.endswith('.arrow'))
+    for name in names[:-KEEP_MANIFESTS]:
+        if int(name[:-len('.arrow')]) not in keep:
+            try:
+                os.remove(os.path.join(os.path.dirname(path), name))
+            except FileNotFoundError:
+                pass
+
+
+def _cached(key):
+    with _lock:
+        table = _manifests.get(key)
+        if table is not None:
+            _manifests.move_to_end(key)
+        return table
+
+
+def _cache(key, table):
+    with _lock:
+        _manifests[key] = table
+        _manifests.move_to_end(key)
+        while len(_manifests) > KEEP_MANIFESTS:
+            _manifests.popitem(last=False)
+
+
+def manifest(dt, persist=False):
+    """
+    Files of the table version of dt (a DeltaTable or a Snapshot), one row per file, with flattened
+    partition values (partition.pair, partition.year) and statistics (min.date, max.date, ...).
+    Cached in memory. The table schema is kept in the metadata.
+    :param persist: Also cache it on disk (local tables only), for pin() and snapshot().
+    """
+    if isinstance(dt, Snapshot):
+        return dt.get_add_actions()
+    root = local_path(dt)
+    key = (root or dt.table_uri, dt.version())
+    on_disk = root is not None and os.path.exists(_manifest_path(root, key[1]))
+    table = _cached(key)
+    if table is None:
+        if on_disk:
+            table = _read_manifest(_manifest_path(root, key[1]))
+        else:
+            table = pa.table(dt.get_add_actions(flatten=True))
+            schema = dt.to_pyarrow_dataset().schema
+            table = table.replace_schema_metadata({
+                b'table_schema': schema.serialize().to_pybytes(),
+                b'partition_columns': json.dumps(dt.metadata().partition_columns).encode()})
+        _cache(key, table)
+    if persist and root is not None and not on_disk:
+        try:
+            _write_manifest(root, key[1], table)
+        except OSError as e:
+            logger.warning(f"Could not cache the manifest of {root} version {key[1]}: {e}")
+    return table
+
+
+def pins(uri):
+    """
+    Pinned versions of the table, by name.
+    """
+    path = os.path.join(local_path(uri), PINS)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return {name: pin['version'] for name, pin in json.load(f).items()}
+
+
+def _load_pins(root):
+    path = os.path.join(root, PINS)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save_pins(root, values):
+    path = os.path.join(root, PINS)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(values, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def pin(uri, version=None, name='default'):
+    """
+    Pin a version of the table (default: the current one) under a name, and cache its manifest.
+    :return: The pinned version.
+    """
+    from deltalake import DeltaTable
+
+    root = local_path(uri)
+    dt = DeltaTable(uri) if version is None else DeltaTable(uri, version=version)
+    commit = next(c for c in dt.history() if c.get('version', dt.version()) == dt.version())
+    values = _load_pins(root)
+    values[name] = dict(version=dt.version(), timestamp=commit['timestamp'])
+    _save_pins(root, values)
+    manifest(dt, persist=True)
+    logger.info(f"Pinned {uri} version {dt.version()} as {name}")
+    return dt.version()
+
+
+def unpin(uri, name='default'):
+    root = local_path(uri)
+    values = _load_pins(root)
+    values.pop(name, None)
+    _save_pins(root, values)
+
+
+def vacuum_retention_hours(uri):
+    """
+    Vacuum retention keeping the files of every pinned version: 0 without pins.
+    """
+    values = _load_pins(local_path(uri))
+    if not values:
+        return 0
+    oldest = min(pin['timestamp'] for pin in values.values()) / 1000
+    return math.ceil((time.time() - oldest) / 3600) + 1
+
+
+class Snapshot:
+    """
+    Read-only view of one version of a table, served from its cached manifest. It stands in for a
+    DeltaTable in histdata.delta and histdata.resample (get_add_actions, to_pyarrow_table).
+    """
+
+    def __init__(self, uri, version):
+        self.table_uri = local_path(uri) or uri
+        self._version = version
+        self._manifest = None
+
+    def version(self):
+        return self._version
+
+    def get_add_actions(self, flatten=True):
+        if self._manifest is None:
+            root = local_path(self.table_uri)
+            path = _manifest_path(root, self._version) if root else None
+            if path is not None and os.path.exists(path):
+                self._manifest = _cached((root, self._version))
+                if self._manifest is None:
+                    self._manifest = _read_manifest(path)
+                    _cache((root, self._version), self._manifest)
+            else:
+                self._manifest = manifest(self.delta_table(), persist=True)
+        return self._manifest
+
+    @property
+    def schema(self):
+        return pa.ipc.read_schema(pa.py_buffer(self.get_add_actions().schema.metadata[b'table_schema']))
+
+    def delta_table(self):
+        """
+        The DeltaTable at this version (replays the log): for the operations not served by the manifest.
+        """
+        from deltalake import DeltaTable
+
+        return DeltaTable(self.table_uri, version=self._version)
+
+    def files(self, partitions=None):
+        """
+        Manifest rows of the files matching partition filters [(column, '=', value), ...].
+        """
+        files = self.get_add_actions()
+        for column, op, value in partitions or []:
+            if op != '=':
+                raise ValueError(f'Unsupported partition filter: {column} {op} {value}')
+            values = files[f'partition.{column}']
+            files = files.filter(pc.equal(values, pa.scalar(value).cast(values.type)))
+        return files
+
+    def to_pyarrow_dataset(self, partitions=None, files=None):
+        """
+        pyarrow Dataset over the data files of the snapshot (or of the given manifest rows).
+        """
+        files = self.files(partitions) if files is None else files
+        schema = self.schema
+        columns = json.loads(self.get_add_actions().schema.metadata[b'partition_columns'])
+        partitioning = ds.partitioning(pa.schema([schema.field(c) for c in columns]), flavor='hive')
+        paths = [os.path.join(self.table_uri, p) for p in files['path'].to_pylist()]
+        return ds.dataset(paths, schema=schema, format='parquet', partitioning=partitioning,
+                          partition_base_dir=self.table_uri)
+
+    def to_pyarrow_table(self, partitions=None, columns=None, filters=None):
+        return self.to_pyarrow_dataset(partitions).to_table(columns=columns, filter=filters)
+
+
+def snapshot(uri, version=None, name=None):
+    """
+    Snapshot of a table: at `version`, at the version pinned under `name`, or at the current version.
+    A pinned or explicit version whose manifest is cached opens without reading the Delta log.
+    """
+    if version is None and name is not None:
+        version = pins(uri).get(name)
+        if version is None:
+            raise KeyError(f'No version of {uri} pinned as {name}.')
+    if version is None:
+        from deltalake import DeltaTable
+
+        dt = DeltaTable(uri)
+        result = Snapshot(uri, dt.version())
+        result._manifest = manifest(dt, persist=True)
+        return result
+    return Snapshot(uri, version)
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from histdata import metrics
+from histdata.log import get_project_logger
+
+logger = get_project_logger(__name__)
+
+# Downloads per second allowed by default when several run concurrently.
+DEFAULT_RATE = 2
+
+# Errors worth retrying. AssertionError is deliberately not in here: download_hist_data
+# raises it when a year/month does not exist, and the callers rely on it to stop.
+RETRYABLE_ERRORS = (requests.exceptions.RequestException, ConnectionError, TimeoutError)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Allows bursts of up to `capacity` requests
+    and a sustained rate of `rate` requests per second.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive.')
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def with_retries(fn, retries=3, backoff=1.0, retry_on=RETRYABLE_ERRORS):
+    """
+    Wrap `fn` so that transient errors are retried with exponential backoff.
+    """
+
+    def wrapped(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except retry_on as e:
+                if attempt >= retries:
+                    raise
+                delay = backoff * (2 ** attempt)
+                metrics.increment('retries')
+                logger.warning(f"Attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    return wrapped
+
+
+def polite(fn, rate=None, retries=3, backoff=1.0):
+    """
+    Wrap a download function (typically download_hist_data) with a shared
+    rate limiter and per-call retries. Every attempt, including retries,
+    consumes a token from the bucket: the rate counts downloads, each of which
+    makes up to two HTTP requests (the token page and the archive).
+    :param rate: Downloads per second, None for no limit.
+    """
+    bucket = TokenBucket(rate) if rate else None
+
+    def limited(*args, **kwargs):
+        if bucket is not None:
+            bucket.acquire()
+        return fn(*args, **kwargs)
+
+    return with_retries(limited, retries=retries, backoff=backoff)
+
+
+def run_pool(fn, items, workers=1):
+    """
+    Call `fn(item)` for every item, keeping at most `workers` calls in flight.
+    With workers=1 everything runs sequentially on the calling thread.
+    Returns the results in the order of `items`.
+    """
+    items = list(items)
+    if workers <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, items))
+
+
+def settings_from_env(workers=None):
+    """
+    Read the concurrency settings shared by the download entry points.
+    FX_DATA_WORKERS: number of concurrent jobs (default 1, i.e. sequential), unless workers is given.
+    FX_DATA_RATE: max downloads started per second (default: no limit for a sequential run,
+                  DEFAULT_RATE with several workers).
+    FX_DATA_RETRIES: retries per download on network errors (default 3).
+    """
+    workers = int(os.environ.get('FX_DATA_WORKERS', 1)) if workers is None else workers
+    rate = os.environ.get('FX_DATA_RATE')
+    return dict(workers=workers,
+                rate=float(rate) if rate else (DEFAULT_RATE if workers > 1 else None),
+                retries=int(os.environ.get('FX_DATA_RETRIES', 3)))
@@ -0,0 +1,222 @@
+"""
+Synthetic cross rates: M1 bars of a pair derived from two legs stored in the Delta table.
+
+EURJPY is EURUSD x USDJPY, EURGBP is EURUSD / GBPUSD: a target BASE/QUOTE goes through a common
+currency C with one leg for BASE/C and one for C/QUOTE, each stored in either direction (a leg
+stored the other way round is inverted: 1/open, 1/close, 1/low as the high and 1/high as the low).
+Bars are aligned on their date (minutes where both legs have a bar) and multiplied.
+
+The open and close of a synthetic bar are exact. Its high and low are not: the legs need not reach
+their extremes at the same instant. They are bounded by the product of the leg extremes (outer, a
+range that always contains the true one) and by the open and close (inner, a range always within it).
+
+Crosses are written to the M1 table as regular (pair, year) partitions, only before the first bar
+published by histdata.com for the pair, if any: they backfill the history of crosses listed late
+in pairs.csv and stand in for the crosses missing from it. All the requested crosses are computed
+together, year by year, reading each leg partition once.
+
+Once synthetic bars are written, the first date stored no longer tells where the native bars start:
+from then on the start of the first archive of the pair downloaded by dt_download (the download
+manifest of histdata.plan) does, so a pair published after its cross was derived is never merged over.
+The synthetic bars written before that, at or after the first native date, are then removed once.
+"""
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from deltalake import DeltaTable, write_deltalake
+
+from histdata.delta import (load_state, low_water_mark, partition_filters, partition_predicate, partitions,
+                            save_state)
+from histdata.ingest import write_delta
+from histdata.log import get_project_logger
+from histdata.plan import DONE, Manifest
+from histdata.resample import Bars, read_partition, to_arrow
+
+logger = get_project_logger(__name__)
+
+# Common currencies tried in this order, then any other currency of the stored pairs.
+VIA = ('USD', 'EUR', 'JPY', 'GBP', 'CHF')
+HIGH_LOW = ('outer', 'inner')
+
+
+def split(pair):
+    return pair[:3].upper(), pair[3:].upper()
+
+
+def invert(bars):
+    """
+    Bars of the inverse rate (e.g. USDEUR from EURUSD).
+    """
+    return Bars(bars.start, 1 / bars.open, 1 / bars.low, 1 / bars.high, 1 / bars.close)
+
+
+def _leg(base, quote, stored):
+    """
+    (pair, inverted) of the stored pair quoting base in quote, or None.
+    """
+    if base + quote in stored:
+        return base + quote, False
+    if quote + base in stored:
+        return quote + base, True
+    return None
+
+
+def resolve_legs(target, stored):
+    """
+    The two legs of a cross, as ((pair, inverted), (pair, inverted)).
+    :param stored: Pairs available in the table.
+    :raise ValueError: No common currency joins the base and the quote of the target.
+    """
+    base, quote = split(target)
+    currencies = {c for pair in stored for c in split(pair)} - {base, quote}
+    for via in [c for c in VIA if c in currencies] + sorted(currencies - set(VIA)):
+        first, second = _leg(base, via, stored), _leg(via, quote, stored)
+        if first and second:
+            return first, second
+    raise ValueError(f'No pair of legs found for {target.upper()}.')
+
+
+def cross(first, second, high_low='outer'):
+    """
+    Product of two series of bars, on the dates present in both.
+    :param high_low: 'outer' bounds the high and low with the products of the leg extremes,
+                     'inner' with the open and close of the synthetic bar.
+    """
+    if high_low not in HIGH_LOW:
+        raise ValueError(f'Unknown high/low bound: {high_low}')
+    start, i, j = np.intersect1d(first.start, second.start, assume_unique=True, return_indices=True)
+    open = first.open[i] * second.open[j]
+    close = first.close[i] * second.close[j]
+    if high_low == 'outer':
+        high, low = first.high[i] * second.high[j], first.low[i] * second.low[j]
+    else:
+        high, low = np.maximum(open, close), np.minimum(open, close)
+    return Bars(start, open, high, low, close)
+
+
+def _years(dt):
+    years = {}
+    for p in partitions(dt):
+        years.setdefault(p['pair'], set()).add(int(p['year']))
+    return years
+
+
+def native_start(output, dt, target, values):
+    """
+    First date (ISO string) of the bars of the target published by histdata.com, or None.
+    :param values: State of the target in the crosses job state, if any. A first native date found
+                   before is kept; without synthetic bars written yet (no last_year), it is the first
+                   date stored; otherwise the start of the first period of the target downloaded.
+    """
+    if values.get('native_first') is not None:
+        return values['native_first']
+    if values.get('last_year') is None:
+        first = low_water_mark(dt, target)
+        return first.isoformat() if first else None
+    downloaded = [(job['year'], job['month'] or 1) for job in Manifest.for_output(output, 'delta').jobs.values()
+                  if job['pair'] == target and job['status'] == DONE]
+    if not downloaded:
+        return None
+    return datetime(*min(downloaded), 1).isoformat()
+
+
+def drop_stale(output, target, year, synthetic, native_first):
+    """
+    Remove the synthetic bars of a (target, year) partition dated at or after the first native date:
+    bars derived before histdata.com published the target. A stored bar is synthetic when its open and
+    close are those of the synthetic bar of its date (exact whatever the high_low mode it was derived
+    with); the native bars downloaded over them have histdata.com's prices.
+    :param synthetic: Bars of the target derived from its legs for the year.
+    :return: Number of bars removed.
+    """
+    if len(synthetic.start) == 0:
+        return 0
+    table = DeltaTable(output).to_pyarrow_table(partitions=partition_filters(target, year)).sort_by('date')
+    seconds = table['date'].cast(pa.timestamp('s')).cast(pa.int64()).to_numpy()
+    index = np.searchsorted(synthetic.start, seconds).clip(max=len(synthetic.start) - 1)
+    stale = ((synthetic.start[index] == seconds)
+             & (synthetic.open[index] == table['open'].to_numpy())
+             & (synthetic.close[index] == table['close'].to_numpy())
+             & (seconds >= np.datetime64(native_first, 's').astype(np.int64)))
+    if stale.any():
+        write_deltalake(output, table.filter(pa.array(~stale)), mode='overwrite',
+                        predicate=partition_predicate(target, year), partition_by=['pair', 'year'])
+    return int(stale.sum())
+
+
+def derive(output, targets, high_low='outer', force=False):
+    """
+    Compute the synthetic bars of the target pairs from the legs in the M1 table at output, and
+    upsert them into it, never at or after the first native date of the target (see native_start),
+    looked up again on every run. The last year written is kept in the job state, so later runs only
+    recompute the years from the last one written onwards (all of them with force=True).
+    When the first native date of a target is found after synthetic bars were written, the years
+    written from that date on are listed in the job state (stale) and their synthetic bars removed.
+    :return: Number of bars written per target.
+    """
+    dt = DeltaTable(output)
+    stored_years = _years(dt)
+    state = load_state(output, 'crosses')
+
+    plans = {}
+    targets = [t.upper() for t in targets]
+    for target in targets:
+        # Crosses are never built from other synthetic crosses.
+        legs = resolve_legs(target, set(stored_years) - set(targets))
+        values = state.setdefault(target, dict(native_first=None, last_year=None))
+        native_first = native_start(output, dt, target, values)
+        if values['native_first'] is None and native_first is not None and values['last_year'] is not None:
+            values['stale'] = list(range(int(native_first[:4]), values['last_year'] + 1))
+        values['native_first'] = native_first
+        years = stored_years[legs[0][0]] & stored_years[legs[1][0]]
+        stale = years & set(values.get('stale', []))
+        if native_first is not None:
+            years = {y for y in years if y <= int(native_first[:4])}
+        if values['last_year'] is not None and not force:
+            years = {y for y in years if y >= values['last_year']}
+        plans[target] = (legs, years, stale)
+        logger.info(f"{target} = {' x '.join(('1/' if inverted else '') + pair for pair, inverted in legs)}, "
+                    f"{len(years)} years to derive" + (f", {len(stale)} years to clear" if stale else ''))
+    save_state(output, 'crosses', state)
+
+    written = {target: 0 for target in plans}
+    for year in sorted(set().union(*(years | stale for _, years, stale in plans.values()))):
+        # Each leg partition of the year is read once, whatever the number of crosses using it.
+        bars = {}
+        for target, (legs, years, stale) in plans.items():
+            if year not in years and year not in stale:
+                continue
+            for pair, _ in legs:
+                if pair not in bars:
+                    bars[pair] = Bars(*read_partition(dt, pair, year))
+            first, second = (invert(bars[pair]) if inverted else bars[pair] for pair, inverted in legs)
+            synthetic = cross(_unique(first), _unique(second), high_low)
+            native_first = state[target]['native_first']
+            if year in stale:
+                removed = drop_stale(output, target, year, synthetic, native_first)
+                state[target]['stale'].remove(year)
+                logger.info(f"  {target} {year}: removed {removed} synthetic bars after {native_first}")
+            if year not in years:
+                continue
+            table = to_arrow(synthetic, target)
+            if native_first is not None:
+                table = table.filter(pc.less(table['date'], pa.scalar(np.datetime64(native_first, 'us'))))
+            if table.num_rows:
+                write_delta(output, table, target, year, mode='merge')
+            written[target] += table.num_rows
+            state[target]['last_year'] = year
+        save_state(output, 'crosses', state)
+        logger.info(f"  {year}: {', '.join(f'{t} {n}' for t, n in written.items())}")
+    return written
+
+
+def _unique(bars):
+    """
+    Bars with duplicated dates (in a table not cleaned yet by dt_clean) reduced to their first bar.
+    """
+    start, first = np.unique(bars.start, return_index=True)
+    if len(start) == len(bars.start):
+        return bars
+    return Bars(start, *(a[first] for a in bars[1:]))
@@ -0,0 +1,158 @@
+"""
+Helpers reading the metadata of the (pair, year) partitioned Delta table.
+Everything here works from the transaction log (partition values and per-file statistics),
+so no data file is opened unless the statistics are missing.
+"""
+import hashlib
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+def add_actions(dt):
+    """
+    Files of the current table version, one row per file, with flattened
+    partition values (partition.pair, partition.year) and statistics (min.date, max.date, ...).
+    Read from the manifest cached per table version (see histdata.catalog).
+    """
+    from histdata.catalog import manifest
+
+    return manifest(dt)
+
+
+def pair_files(dt, pair):
+    actions = add_actions(dt)
+    return actions.filter(pc.equal(actions['partition.pair'], pair.upper()))
+
+
+def high_water_mark(dt, pair):
+    """
+    Latest date stored for a pair.
+    Uses the max.date statistic of the files in the pair's last year partition. If a file
+    of that partition has no statistics, only the date column of that partition is read.
+    :return: datetime.datetime, or None if the pair has no data.
+    """
+    files = pair_files(dt, pair)
+    if files.num_rows == 0:
+        return None
+    return last_date(dt, pair, pc.max(files['partition.year']).as_py())
+
+
+def last_date(dt, pair, year):
+    """
+    Latest date stored in a (pair, year) partition, from the max.date statistic of its files
+    (or its date column, if a file has no statistics).
+    :return: datetime.datetime, or None if the partition is empty.
+    """
+    files = pair_files(dt, pair)
+    files = files.filter(pc.equal(files['partition.year'], int(year)))
+    if files.num_rows == 0:
+        return None
+    if 'max.date' in files.column_names and files['max.date'].null_count == 0:
+        return pc.max(files['max.date']).as_py()
+    dates = dt.to_pyarrow_table(partitions=partition_filters(pair.upper(), year), columns=['date'])
+    return pc.max(dates['date']).as_py()
+
+
+def low_water_mark(dt, pair):
+    """
+    Earliest date stored for a pair, the same way as high_water_mark from the pair's first year partition.
+    :return: datetime.datetime, or None if the pair has no data.
+    """
+    files = pair_files(dt, pair)
+    if files.num_rows == 0:
+        return None
+    first_year = pc.min(files['partition.year']).as_py()
+    files = files.filter(pc.equal(files['partition.year'], first_year))
+    if 'min.date' in files.column_names and files['min.date'].null_count == 0:
+        return pc.min(files['min.date']).as_py()
+    dates = dt.to_pyarrow_table(partitions=partition_filters(pair.upper(), first_year), columns=['date'])
+    return pc.min(dates['date']).as_py()
+
+
+def partitions(dt):
+    """
+    Group the files of the table by (pair, year) partition.
+    :return: List of dicts with pair, year, files (paths), num_files, size_bytes, num_records and
+             fingerprint. The fingerprint changes whenever a file of the partition is added or removed.
+    """
+    actions = add_actions(dt)
+    grouped = {}
+    for path, size, records, pair, year in zip(actions['path'].to_pylist(),
+                                               actions['size_bytes'].to_pylist(),
+                                               actions['num_records'].to_pylist(),
+                                               actions['partition.pair'].to_pylist(),
+                                               actions['partition.year'].to_pylist()):
+        part = grouped.setdefault((pair, year), dict(pair=pair, year=year, files=[], size_bytes=0, num_records=0))
+        part['files'].append(path)
+        part['size_bytes'] += size
+        part['num_records'] += records or 0
+    result = []
+    for part in grouped.values():
+        part['files'].sort()
+        part['num_files'] = len(part['files'])
+        part['fingerprint'] = hashlib.sha1('\n'.join(part['files']).encode()).hexdigest()
+        result.append(part)
+    return sorted(result, key=lambda p: (p['pair'], p['year']))
+
+
+def date_stats_missing(dt, pair, year):
+    """
+    Number of files of a (pair, year) partition without min/max statistics on date.
+    Files without them can never be skipped by a date range query.
+    """
+    files = pair_files(dt, pair)
+    files = files.filter(pc.equal(files['partition.year'], int(year)))
+    if 'min.date' not in files.column_names or 'max.date' not in files.column_names:
+        return files.num_rows
+    return pc.sum(pc.or_(pc.is_null(files['min.date']), pc.is_null(files['max.date']))).as_py() or 0
+
+
+def scan_cost(dt, pair, start, end):
+    """
+    Files and bytes a query of a pair over [start, end) has to read once the files are pruned
+    on their partition values and date statistics (see histdata.query).
+    :param start: datetime.datetime.
+    :param end: datetime.datetime.
+    :return: dict with files and bytes.
+    """
+    files = pair_files(dt, pair)
+    years = files['partition.year']
+    keep = pc.and_(pc.greater_equal(years, start.year), pc.less_equal(years, end.year))
+    if 'min.date' in files.column_names and 'max.date' in files.column_names:
+        overlaps = pc.and_(pc.less(files['min.date'], pa.scalar(end, files.schema.field('min.date').type)),
+                           pc.greater_equal(files['max.date'], pa.scalar(start, files.schema.field('max.date').type)))
+        keep = pc.and_(keep, pc.fill_null(overlaps, True))
+    files = files.filter(keep)
+    return dict(files=files.num_rows, bytes=pc.sum(files['size_bytes']).as_py() or 0)
+
+
+def partition_filters(pair, year):
+    return [('pair', '=', pair), ('year', '=', str(year))]
+
+
+def partition_predicate(pair, year):
+    return f"pair = '{pair}' AND year = {int(year)}"
+
+
+# Job state lives next to the table. Delta ignores (and vacuum never deletes) paths starting with '_'.
+STATE_DIR = '_fx_state'
+
+
+def load_state(table_uri, name):
+    path = os.path.join(table_uri, STATE_DIR, f'{name}.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(table_uri, name, state):
+    directory = os.path.join(table_uri, STATE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
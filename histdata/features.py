@@ -0,0 +1,122 @@
+"""
+Rolling features of the M1 bars (returns, volatility, ATR, session highs and lows), computed per
+(pair, year) partition with O(1) per bar window kernels.
+
+Windows are counted in bars. Rolling sums are differences of cumulative sums, so a window of any
+length costs the same per bar; session extremes are running maxima/minima restarted at every
+session open (17:00 New York time, as the D1 bars of histdata.resample).
+
+A window at the start of a year reaches back into the previous year. Rather than threading state
+from one partition to the next, a partition is computed with the end of the previous year prepended
+(see WARMUP: enough for the longest window and the session in progress), and those rows are then
+dropped: every year can be computed on its own, in any order or in parallel, with the same result
+as one pass over the whole history.
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from histdata.resample import SESSIONS, bucket_keys
+
+VOLATILITY_WINDOWS = (60, 1440)
+ATR_WINDOWS = (14, 60)
+
+# Bars of the previous year read to warm the windows up: the last week, which normally holds more than
+# the longest window and the session in progress, and at least WARMUP_BARS bars.
+WARMUP = np.timedelta64(7, 'D')
+WARMUP_BARS = max(VOLATILITY_WINDOWS + ATR_WINDOWS)
+
+FEATURE_SCHEMA = pa.schema([('date', pa.timestamp('us')),
+                            ('ret', pa.float64()),
+                            ('log_ret', pa.float64())] +
+                           [(f'vol_{w}', pa.float64()) for w in VOLATILITY_WINDOWS] +
+                           [(f'atr_{w}', pa.float64()) for w in ATR_WINDOWS] +
+                           [('session_high', pa.float64()),
+                            ('session_low', pa.float64()),
+                            ('year', pa.int32()),
+                            ('pair', pa.string())])
+
+
+def rolling_sum(values, window):
+    """
+    Sum of each value and the window - 1 values before it (partial windows at the start).
+    """
+    total = np.cumsum(values, dtype=np.float64)
+    total[window:] = total[window:] - total[:-window]
+    return total
+
+
+def rolling_mean(values, window):
+    """
+    Mean over `window` finite values; NaN where the window holds a non-finite value or is incomplete.
+    """
+    finite = np.isfinite(values)
+    count = rolling_sum(finite, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = rolling_sum(np.where(finite, values, 0), window) / window
+    mean[count < window] = np.nan
+    return mean
+
+
+def rolling_std(values, window):
+    """
+    Sample standard deviation over `window` values, as pandas' rolling(window).std().
+    """
+    finite = np.isfinite(values)
+    clean = np.where(finite, values, 0)
+    # Centering on the overall mean keeps the sums of squares small and the difference accurate.
+    clean = clean - (clean[finite].mean() if finite.any() else 0)
+    count = rolling_sum(finite, window)
+    total = rolling_sum(clean, window)
+    squares = rolling_sum(clean * clean, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = (squares - total * total / window) / (window - 1)
+    std = np.sqrt(np.maximum(variance, 0))
+    std[count < window] = np.nan
+    return std
+
+
+def true_range(high, low, close):
+    """
+    True range of each bar: its high - low, extended to the previous close.
+    """
+    previous = np.concatenate(([np.nan], close[:-1]))
+    return np.fmax(high - low, np.fmax(np.abs(high - previous), np.abs(low - previous)))
+
+
+def session_extremes(seconds, high, low, session=SESSIONS['new_york']):
+    """
+    Highest high and lowest low since the open of the session of each bar.
+    """
+    keys = bucket_keys(seconds, 86400, session)
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [len(keys)]))
+    session_high, session_low = np.empty_like(high), np.empty_like(low)
+    for start, end in zip(starts[:-1], starts[1:]):
+        np.maximum.accumulate(high[start:end], out=session_high[start:end])
+        np.minimum.accumulate(low[start:end], out=session_low[start:end])
+    return session_high, session_low
+
+
+def compute(seconds, open, high, low, close, pair, warmup=0):
+    """
+    Features of the M1 bars of one pair, sorted by date.
+    :param seconds: int64 EST epoch seconds.
+    :param warmup: Number of leading bars belonging to the previous partition: they feed the
+                   windows but get no row in the result.
+    :return: Arrow table matching FEATURE_SCHEMA.
+    """
+    previous = np.concatenate(([np.nan], close[:-1]))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ret = close / previous - 1
+        log_ret = np.log(close / previous)
+    log_ret[~np.isfinite(log_ret)] = np.nan
+    columns = [ret, log_ret]
+    columns += [rolling_std(log_ret, w) for w in VOLATILITY_WINDOWS]
+    columns += [rolling_mean(true_range(high, low, close), w) for w in ATR_WINDOWS]
+    columns += list(session_extremes(seconds, high, low))
+
+    date = pa.array(seconds[warmup:].astype('datetime64[s]').astype('datetime64[us]'))
+    return pa.Table.from_arrays([date] +
+                                [pa.array(c[warmup:], from_pandas=True) for c in columns] +
+                                [pc.year(date).cast(pa.int32()), pa.repeat(pair.upper(), len(date))],
+                                schema=FEATURE_SCHEMA)
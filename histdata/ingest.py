@@ -0,0 +1,105 @@
+"""
+Streaming ingest of histdata archives into the Delta table.
+The archive (spooled to a temporary file by histdata.api) has its CSV member read in
+fixed-size record batches, so memory use does not grow with the size of the month.
+"""
+from zipfile import ZipFile
+
+from deltalake import DeltaTable, write_deltalake
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+
+M1_COLUMNS = ['date', 'open', 'high', 'low', 'close', 'volume']
+M1_TIMESTAMP_FORMAT = '%Y%m%d %H%M%S'
+
+# Same layout as the frames written by the pandas path of download_hist_data.
+M1_SCHEMA = pa.schema([('date', pa.timestamp('us')),
+                       ('open', pa.float64()),
+                       ('high', pa.float64()),
+                       ('low', pa.float64()),
+                       ('close', pa.float64()),
+                       ('year', pa.int32()),
+                       ('pair', pa.string())])
+
+BLOCK_SIZE = 4 << 20  # bytes of CSV per record batch.
+
+
+def open_csv_member(zip_file):
+    """
+    Return the CSV member of a histdata archive as a file object, or None if there is none.
+    """
+    for name in zip_file.namelist():
+        if '.csv' in name:
+            return zip_file.open(name)
+    return None
+
+
+def m1_batches(file, pair, block_size=BLOCK_SIZE):
+    """
+    Parse the CSV member of an M1 archive into record batches matching M1_SCHEMA.
+    :param file: Path or binary file object of the ZIP archive.
+    :param pair: Currency pair. Example: eurusd.
+    :param block_size: Approximate number of CSV bytes per batch.
+    """
+    with ZipFile(file, 'r') as zip_file:
+        member = open_csv_member(zip_file)
+        if member is None:
+            return
+        with member:
+            reader = pcsv.open_csv(
+                member,
+                read_options=pcsv.ReadOptions(column_names=M1_COLUMNS, block_size=block_size),
+                parse_options=pcsv.ParseOptions(delimiter=';'),
+                convert_options=pcsv.ConvertOptions(
+                    column_types={'date': pa.timestamp('s'),
+                                  'open': pa.float64(),
+                                  'high': pa.float64(),
+                                  'low': pa.float64(),
+                                  'close': pa.float64()},
+                    timestamp_parsers=[M1_TIMESTAMP_FORMAT],
+                    include_columns=M1_COLUMNS[:-1]))
+            pair = pair.upper()
+            for batch in reader:
+                date = batch.column('date').cast(pa.timestamp('us'))
+                yield pa.record_batch([date,
+                                       batch.column('open'),
+                                       batch.column('high'),
+                                       batch.column('low'),
+                                       batch.column('close'),
+                                       pc.year(date).cast(pa.int32()),
+                                       pa.repeat(pair, batch.num_rows)],
+                                      schema=M1_SCHEMA)
+
+
+def m1_reader(file, pair, block_size=BLOCK_SIZE):
+    """
+    Same as m1_batches, wrapped in a pyarrow.RecordBatchReader that write_deltalake consumes lazily.
+    """
+    return pa.RecordBatchReader.from_batches(M1_SCHEMA, m1_batches(file, pair, block_size))
+
+
+
+def write_delta(output_directory, data, pair, year, mode='append'):
+    """
+    Write M1 bars of one pair and year to the Delta table.
+    :param data: pandas DataFrame, pyarrow Table or RecordBatchReader in the M1_SCHEMA layout.
+    :param mode: 'append' adds the rows as they are. 'merge' upserts them keyed on (pair, date):
+                 only the files of the (pair, year) partition are read and rewritten, and
+                 downloading a period twice does not create duplicates.
+    """
+    if mode == 'merge' and DeltaTable.is_deltatable(output_directory):
+        if not isinstance(data, (pa.Table, pa.RecordBatchReader)):
+            data = pa.Table.from_pandas(data, preserve_index=False)
+        predicate = (f"t.pair = '{pair.upper()}' AND t.year = {int(year)} "
+                     f"AND t.pair = s.pair AND t.date = s.date")
+        (DeltaTable(output_directory)
+         .merge(source=data, predicate=predicate, source_alias='s', target_alias='t')
+         .when_matched_update_all()
+         .when_not_matched_insert_all()
+         .execute())
+    elif mode in ('append', 'merge'):
+        write_deltalake(output_directory, data, mode='append', partition_by=['pair', 'year'])
+    else:
+        raise ValueError(f'Unknown write mode: {mode}')
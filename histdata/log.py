@@ -0,0 +1,167 @@
+"""
+Shared logging configuration for FX data download project (also importable as fx_logging).
+
+Project loggers (get_project_logger) do not write anything themselves: records are put on a
+queue, and a single QueueListener thread formats them and writes them to stdout and to
+logs/<module>.log. Threads and download workers therefore never block on console or disk I/O.
+Nothing is configured at import time: the listener is started, and the log directory created,
+when the first record is emitted.
+
+FX_DATA_LOG_LEVEL sets the level of the project loggers (default INFO) and FX_DATA_LOG_DIR the
+directory of the log files (default 'logs', empty to disable the files).
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def setup_logger(
+    name: str = __name__,
+    level: int = logging.INFO,
+    log_file: Optional[str] = None,
+    console_output: bool = True
+) -> logging.Logger:
+    """
+    Setup a logger with consistent formatting across the project.
+    Unlike get_project_logger, the handlers are attached to the logger itself and write synchronously.
+
+    Args:
+        name: Logger name (typically __name__)
+        level: Logging level (default: INFO)
+        log_file: Optional log file path
+        console_output: Whether to output to console (default: True)
+
+    Returns:
+        Configured logger instance
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+
+    # Remove existing handlers to avoid duplicates
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+
+    # Create formatter
+    formatter = logging.Formatter(FORMAT, datefmt=DATE_FORMAT)
+
+    # Console handler
+    if console_output:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(level)
+        console_handler.setFormatter(formatter)
+        logger.addHandler(console_handler)
+
+    # File handler
+    if log_file:
+        # Create logs directory if it doesn't exist
+        log_dir = os.path.dirname(log_file) if os.path.dirname(log_file) else 'logs'
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setLevel(logging.DEBUG)  # More detailed logging to file
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
+
+    return logger
+
+
+class _ModuleFileHandler(logging.Handler):
+    """
+    Writes each record to <directory>/<logger name>.log, opening the files on first use.
+    Only called from the listener thread.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self._handlers = {}
+
+    def emit(self, record):
+        handler = self._handlers.get(record.name)
+        if handler is None:
+            os.makedirs(self.directory, exist_ok=True)
+            handler = logging.FileHandler(os.path.join(self.directory, f"{record.name.replace('.', '_')}.log"))
+            handler.setFormatter(self.formatter)
+            self._handlers[record.name] = handler
+        handler.handle(record)
+
+    def close(self):
+        for handler in self._handlers.values():
+            handler.close()
+        self._handlers.clear()
+        super().close()
+
+
+def _start_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        formatter = logging.Formatter(FORMAT, datefmt=DATE_FORMAT)
+        handlers = [logging.StreamHandler(sys.stdout)]
+        log_dir = os.environ.get('FX_DATA_LOG_DIR', 'logs')
+        if log_dir:
+            handlers.append(_ModuleFileHandler(log_dir))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        _listener = QueueListener(_queue, *handlers)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """
+    Write out the queued records and stop the listener thread. Logging again restarts it.
+    """
+    global _listener
+    with _listener_lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Puts records on the shared queue, starting the listener with the first one.
+    """
+
+    def emit(self, record):
+        if _listener is None:
+            _start_listener()
+        super().emit(record)
+
+
+_handler = _LazyQueueHandler(_queue)
+
+
+def get_project_logger(module_name: str) -> logging.Logger:
+    """
+    Get a logger with standard project configuration.
+    This has no side effect besides attaching the shared queue handler to the logger.
+
+    Args:
+        module_name: Name of the module (typically __name__)
+
+    Returns:
+        Configured logger instance
+    """
+    logger = logging.getLogger(module_name)
+    if _handler not in logger.handlers:
+        logger.setLevel(os.environ.get('FX_DATA_LOG_LEVEL', 'INFO').upper())
+        logger.addHandler(_handler)
+    return logger
@@ -0,0 +1,246 @@
+"""
+Timing and throughput instrumentation of the download and ingest pipeline.
+
+Code is instrumented with spans:
+
+    with metrics.span('post', pair=pair) as s:
+        r = post(...)
+        s.add(bytes=len(r.content))
+
+Each finished span becomes a JSON event (stage, seconds, bytes, rows, retries, error and the
+fields given to span()) that is appended to a JSON lines file and handed to the registered
+exporters. report() logs and writes a summary per stage with duration percentiles.
+
+Instrumentation is off unless enable() is called (or FX_DATA_METRICS is set for the entry points,
+see configure_from_env). When off, span() returns a shared no-op object, so an instrumented call
+costs one global lookup.
+"""
+import json
+import os
+import threading
+import time
+
+from histdata.log import get_project_logger
+
+logger = get_project_logger(__name__)
+
+PERCENTILES = (50, 90, 99)
+
+_recorder = None
+_local = threading.local()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counts):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+
+    def __init__(self, recorder, stage, fields):
+        self.recorder = recorder
+        self.stage = stage
+        self.fields = fields
+        self.counts = dict(bytes=0, rows=0, retries=0)
+
+    def add(self, **counts):
+        """
+        Add to the bytes, rows, retries (or any other count) of the span.
+        """
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + (value or 0)
+
+    def __enter__(self):
+        stack = getattr(_local, 'spans', None)
+        if stack is None:
+            stack = _local.spans = []
+        self.parent = stack[-1].stage if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _local.spans.pop()
+        event = dict(ts=time.time(), stage=self.stage, seconds=seconds, parent=self.parent,
+                     error=None if exc_type is None else exc_type.__name__)
+        event.update(self.counts)
+        event.update(self.fields)
+        self.recorder.emit(event)
+        return False
+
+
+class Recorder:
+    """
+    Collects the span events of a run: writes them to a JSON lines file, passes them to the
+    exporters and keeps the durations and counts per stage for the summary.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.exporters = []
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, 'a')
+
+    def emit(self, event):
+        with self._lock:
+            stage = self._stages.setdefault(event['stage'], dict(seconds=[], bytes=0, rows=0, retries=0, errors=0))
+            stage['seconds'].append(event['seconds'])
+            stage['bytes'] += event.get('bytes') or 0
+            stage['rows'] += event.get('rows') or 0
+            stage['retries'] += event.get('retries') or 0
+            stage['errors'] += event['error'] is not None
+        self.write(event)
+        for exporter in self.exporters:
+            try:
+                exporter(event)
+            except Exception as e:
+                logger.warning(f"Metrics exporter {exporter!r} failed: {e}")
+
+    def write(self, event):
+        """
+        Append an event to the JSON lines file, if any.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(event, default=str) + '\n')
+                self._file.flush()
+
+    def summary(self):
+        """
+        Per stage: count, total/mean seconds, duration percentiles, bytes, rows, retries, errors and throughput.
+        """
+        import numpy as np
+
+        with self._lock:
+            stages = {name: dict(values, seconds=list(values['seconds'])) for name, values in self._stages.items()}
+        result = {}
+        for name, values in stages.items():
+            seconds = np.array(values['seconds'])
+            total = float(seconds.sum())
+            result[name] = dict(count=len(seconds),
+                                seconds=total,
+                                mean_seconds=total / len(seconds),
+                                max_seconds=float(seconds.max()),
+                                bytes=values['bytes'],
+                                rows=values['rows'],
+                                retries=values['retries'],
+                                errors=values['errors'],
+                                mb_per_second=values['bytes'] / total / 1e6 if total else None,
+                                rows_per_second=values['rows'] / total if total else None,
+                                **{f'p{p}_seconds': float(np.percentile(seconds, p)) for p in PERCENTILES})
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def enable(path=None):
+    """
+    Start recording spans, to the JSON lines file at path if given.
+    :return: The Recorder.
+    """
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = Recorder(path)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def configure_from_env():
+    """
+    FX_DATA_METRICS: JSON lines file receiving the events ('1' records without writing events).
+    Does nothing if it is unset or instrumentation is already enabled.
+    """
+    value = os.environ.get('FX_DATA_METRICS')
+    if value and _recorder is None:
+        enable(None if value == '1' else value)
+    return _recorder
+
+
+def add_exporter(exporter):
+    """
+    Register a callable receiving every event dict, e.g. to push them to a metrics backend.
+    Has no effect while instrumentation is off.
+    """
+    if _recorder is not None:
+        _recorder.exporters.append(exporter)
+
+
+def span(stage, **fields):
+    """
+    Context manager timing a stage of the pipeline. Extra fields (pair, year, ...) go in the event.
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_SPAN
+    return Span(recorder, stage, fields)
+
+
+def record(stage, seconds, **fields):
+    """
+    Emit an event measured elsewhere (e.g. in a worker process), with counts such as bytes or rows in fields.
+    """
+    recorder = _recorder
+    if recorder is None:
+        return
+    event = dict(ts=time.time(), stage=stage, seconds=seconds, parent=None, error=None, bytes=0, rows=0, retries=0)
+    event.update(fields)
+    recorder.emit(event)
+
+
+def increment(name='retries', value=1):
+    """
+    Add to a count of the innermost open span of the current thread.
+    """
+    if _recorder is None:
+        return
+    stack = getattr(_local, 'spans', None)
+    if stack:
+        stack[-1].add(**{name: value})
+
+
+def report():
+    """
+    Log the summary of the run and append it to the events file as a 'summary' event.
+    :return: The summary (see Recorder.summary), or None when instrumentation is off.
+    """
+    recorder = _recorder
+    if recorder is None:
+        return None
+    summary = recorder.summary()
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+        logger.info(f"{name:16s} n={s['count']:<6d} total={s['seconds']:9.3f}s p50={s['p50_seconds']:.4f}s "
+                    f"p90={s['p90_seconds']:.4f}s p99={s['p99_seconds']:.4f}s bytes={s['bytes']} rows={s['rows']} "
+                    f"retries={s['retries']} errors={s['errors']}")
+    recorder.write(dict(ts=time.time(), stage='summary', stages=summary))
+    return summary
@@ -0,0 +1,179 @@
+"""
+Multi-pair panels: the bars of many pairs aligned on a common time index, built in bounded memory.
+
+The range is walked one calendar month at a time. For each month, the sorted dates of every pair
+are read from the Delta table (only the files and row groups overlapping the month, see
+histdata.query) and merged into the month's index: the union of the dates of all pairs, or every
+minute of the month. Each pair is then aligned on the index with binary searches, and the aligned
+rows are cut into fixed-size chunks. At most a month of bars per pair and one chunk are held in
+memory, whatever the length of the range.
+
+Missing bars are NaN, or with fill='ffill' the last known value of the pair, carried across months
+(optionally only for `limit` seconds).
+"""
+from collections import namedtuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from histdata.delta import partitions
+from histdata.query import _timestamp, dataset, open_table, table_uri
+from histdata.resample import TIMEFRAMES
+
+FILLS = (None, 'ffill')
+INDEXES = ('union', 'grid')
+
+CHUNK_SIZE = 64 * 1024
+
+# index: datetime64[s] EST dates. values: (len(index), len(pairs), len(fields)) array.
+Panel = namedtuple('Panel', ['index', 'values', 'pairs', 'fields'])
+
+
+def table_pairs(timeframe='M1', output=None):
+    """
+    Pairs stored in the Delta table of a timeframe.
+    """
+    return sorted({p['pair'] for p in partitions(open_table(table_uri(timeframe, output)))})
+
+
+def _windows(start, end):
+    """
+    [start, end) cut on calendar months, as pairs of datetime64[s].
+    """
+    bounds = np.arange(start.astype('datetime64[M]') + 1, end.astype('datetime64[M]') + 1).astype('datetime64[s]')
+    bounds = np.concatenate(([start], bounds[bounds < end], [end]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class _Aligner:
+    """
+    Aligns the bars of one pair on successive index slices, keeping the last value for forward fill.
+    """
+
+    def __init__(self, pair, fields, timeframe, output, start, end, fill, limit):
+        self.source, self.condition = dataset(pair, start, end, timeframe, output)
+        self.fields = list(fields)
+        self.fill = fill
+        self.limit = limit
+        self.last_date = None
+        self.last_values = np.full(len(fields), np.nan)
+
+    def read(self, start, end):
+        """
+        Dates (int64 seconds, unique and sorted) and values (rows x fields) of the pair in [start, end).
+        """
+        condition = (self.condition & (ds.field('date') >= pa.scalar(start, pa.timestamp('s'))) &
+                     (ds.field('date') < pa.scalar(end, pa.timestamp('s'))))
+        table = self.source.to_table(columns=['date'] + self.fields, filter=condition).sort_by('date')
+        dates = table['date'].cast(pa.timestamp('s')).cast(pa.int64()).to_numpy()
+        values = np.column_stack([table[name].to_numpy() for name in self.fields]) if len(dates) else \
+            np.empty((0, len(self.fields)))
+        # Duplicated dates (in a table not cleaned yet by dt_clean) keep their first bar.
+        dates, first = np.unique(dates, return_index=True)
+        return dates, values[first]
+
+    def align(self, index, dates, values, out):
+        """
+        Write the values of the pair at each date of index (sorted int64 seconds) into out (len(index) x fields).
+        """
+        if self.fill is None:
+            position = np.minimum(np.searchsorted(dates, index), max(len(dates) - 1, 0))
+            hit = (dates[position] == index) if len(dates) else np.zeros(len(index), dtype=bool)
+            out[:] = np.nan
+            out[hit] = values[position[hit]]
+            return
+        position = np.searchsorted(dates, index, side='right') - 1
+        known = position >= 0
+        out[known] = values[position[known]]
+        out[~known] = self.last_values
+        if self.limit is not None:
+            last = np.full(len(index), np.nan if self.last_date is None else self.last_date, dtype=np.float64)
+            last[known] = dates[position[known]]
+            out[~(index - last <= self.limit)] = np.nan
+        if len(dates):
+            self.last_date, self.last_values = dates[-1], values[-1]
+
+
+def _chunks(pieces, chunk_size):
+    """
+    Regroup a stream of (index, values) pieces into chunks of exactly chunk_size rows (the last one may be shorter).
+    """
+    buffered, rows = [], 0
+    for index, values in pieces:
+        buffered.append((index, values))
+        rows += len(index)
+        while rows >= chunk_size:
+            index = np.concatenate([b[0] for b in buffered])
+            values = np.concatenate([b[1] for b in buffered])
+            yield index[:chunk_size], values[:chunk_size]
+            buffered, rows = [(index[chunk_size:], values[chunk_size:])], rows - chunk_size
+    if rows:
+        yield np.concatenate([b[0] for b in buffered]), np.concatenate([b[1] for b in buffered])
+
+
+def iter_panel(pairs=None, start=None, end=None, fields=('close',), fill='ffill', limit=None, index='union',
+               chunk_size=CHUNK_SIZE, timeframe='M1', output=None, dtype=np.float64):
+    """
+    Bars of several pairs aligned on a common index, in chunks of chunk_size rows.
+    :param pairs: Pairs (columns of the panel), default: every pair of the table.
+    :param start: First date (datetime, numpy.datetime64 or ISO string), EST.
+    :param end: Date after the last bar, EST.
+    :param fields: Bar columns to align (open, high, low, close).
+    :param fill: None leaves the missing bars NaN, 'ffill' repeats the last value of the pair.
+    :param limit: With fill='ffill', do not carry a value more than this many seconds.
+    :param index: 'union' of the dates of the pairs, or 'grid' of every bar of the timeframe (weekends included),
+                  aligned on EST. D1 bars close at 17:00 New York time: use 'union' for them.
+    :param timeframe: M1 or one of the timeframes materialized by dt_resample.py.
+    :return: Iterator of Panel.
+    """
+    if fill not in FILLS:
+        raise ValueError(f'Unknown fill: {fill}')
+    if index not in INDEXES:
+        raise ValueError(f'Unknown index: {index}')
+    if start is None or end is None:
+        raise ValueError('A panel needs a start and an end date.')
+    pairs = table_pairs(timeframe, output) if pairs is None else \
+        [pairs.upper()] if isinstance(pairs, str) else [p.upper() for p in pairs]
+    fields = [fields] if isinstance(fields, str) else list(fields)
+    start, end = _timestamp(start).astype('datetime64[s]'), _timestamp(end).astype('datetime64[s]')
+    step = TIMEFRAMES[timeframe]
+    aligners = [_Aligner(pair, fields, timeframe, output, start, end, fill, limit) for pair in pairs]
+
+    def months():
+        for window_start, window_end in _windows(start, end):
+            bars = [aligner.read(window_start, window_end) for aligner in aligners]
+            if index == 'union':
+                keys = np.unique(np.concatenate([dates for dates, _ in bars]))
+            else:
+                first = -(-window_start.astype(np.int64) // step) * step
+                keys = np.arange(first, window_end.astype(np.int64), step, dtype=np.int64)
+            values = np.empty((len(keys), len(pairs), len(fields)), dtype=dtype)
+            for column, (aligner, (dates, pair_values)) in enumerate(zip(aligners, bars)):
+                aligner.align(keys, dates, pair_values, values[:, column, :])
+            if len(keys):
+                yield keys, values
+
+    for keys, values in _chunks(months(), chunk_size):
+        yield Panel(keys.astype('datetime64[s]'), values, pairs, fields)
+
+
+def to_arrow(panel):
+    """
+    Panel as a wide Arrow table: date, then one column per pair and field, named PAIR_field.
+    """
+    columns = [pa.array(panel.index).cast(pa.timestamp('us'))]
+    names = ['date']
+    for column, pair in enumerate(panel.pairs):
+        for depth, field in enumerate(panel.fields):
+            columns.append(pa.array(panel.values[:, column, depth], from_pandas=True))
+            names.append(f'{pair}_{field}')
+    return pa.Table.from_arrays(columns, names=names)
+
+
+def iter_tables(*args, **kwargs):
+    """
+    Same as iter_panel, yielding wide Arrow tables (see to_arrow).
+    """
+    for panel in iter_panel(*args, **kwargs):
+        yield to_arrow(panel)
@@ -0,0 +1,66 @@
+"""
+Typed Parquet files holding one histdata archive (one pair and period), as an alternative to the ZIP of CSV.
+
+Dates are stored as int64 millisecond timestamps (delta encoded), prices as float32 or float64
+(byte stream split, which zstd compresses much better than plain floats) and the pair as a
+dictionary encoded column. Every row group carries min/max statistics, so readers can skip the
+row groups outside of a date range.
+"""
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from histdata.ingest import m1_batches
+
+PRICE_TYPES = {'float32': pa.float32(),
+               'float64': pa.float64()}
+
+ROW_GROUP_SIZE = 64 * 1024
+
+
+def parquet_schema(time_frame, price_type='float64'):
+    """
+    Schema of the Parquet file of an archive: date, the prices of the time frame and pair.
+    """
+    price = PRICE_TYPES[price_type]
+    if time_frame == 'M1':
+        prices = ['open', 'high', 'low', 'close']
+    else:
+        from histdata.ticks import PRICE_SIDES
+
+        prices = PRICE_SIDES
+    return pa.schema([('date', pa.timestamp('ms'))] +
+                     [(name, price) for name in prices] +
+                     [('pair', pa.dictionary(pa.int8(), pa.string()))])
+
+
+def archive_batches(file, pair, time_frame, price_type='float64'):
+    """
+    Parse an ASCII archive into record batches matching parquet_schema(time_frame, price_type).
+    """
+    schema = parquet_schema(time_frame, price_type)
+    if time_frame == 'M1':
+        batches = m1_batches(file, pair)
+    else:
+        from histdata.ticks import tick_batches
+
+        batches = tick_batches(file, pair, time_frame)
+    for batch in batches:
+        yield pa.record_batch([batch.column(field.name).cast(field.type) for field in schema], schema=schema)
+
+
+def write_parquet(file, output_filename, pair, time_frame, price_type='float64', row_group_size=ROW_GROUP_SIZE):
+    """
+    Convert an ASCII archive to a Parquet file.
+    :param file: Path or binary file object of the ZIP archive.
+    :return: Number of rows written.
+    """
+    rows = 0
+    schema = parquet_schema(time_frame, price_type)
+    prices = [name for name in schema.names if name not in ('date', 'pair')]
+    with pq.ParquetWriter(output_filename, schema, compression='zstd', write_statistics=True,
+                          use_dictionary=['pair'], use_byte_stream_split=prices,
+                          column_encoding={'date': 'DELTA_BINARY_PACKED'}) as writer:
+        for batch in archive_batches(file, pair, time_frame, price_type):
+            writer.write_batch(batch, row_group_size=row_group_size)
+            rows += batch.num_rows
+    return rows
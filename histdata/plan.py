@@ -0,0 +1,247 @@
+"""
+Planning and execution of bulk downloads.
+
+The planner computes the exact list of archives a pair has on histdata.com from its first trading
+month (pairs.csv) and today's date: one archive per past year, one per month of the current year.
+Archives already on disk (or in the Delta table) are left out. The plan is persisted as a manifest
+with the status of every job, and the executor works through the pending jobs, recording each
+outcome as it goes: after a crash, a new run resumes where the previous one stopped.
+"""
+import csv
+import json
+import os
+import threading
+from datetime import datetime
+
+from histdata.api import NoArchiveError
+from histdata.cache import period_end, period_name
+from histdata.concurrency import run_pool
+from histdata.log import get_project_logger
+
+logger = get_project_logger(__name__)
+
+PENDING, DONE, EMPTY, FAILED = 'pending', 'done', 'empty', 'failed'
+
+# Where the manifests live, relative to the output directory. Delta ignores paths starting with '_'.
+# Each consumer (the Delta table, or the archives of a format) has its own: they store different things.
+MANIFEST_DIR = '_fx_state'
+
+
+def read_pairs(path='pairs.csv'):
+    """
+    Pairs of pairs.csv as (pair, first year, first month).
+    """
+    with open(path, 'r') as f:
+        reader = csv.reader(f, delimiter=',')
+        next(reader, None)  # skip the headers
+        return [(pair.upper(), int(first[:4]), int(first[4:6] or 1)) for _, pair, first in reader]
+
+
+def periods(first_year, first_month, today=None):
+    """
+    (year, month) of the archives published since the first trading month: month is None for the
+    past years (one archive per year) and set for the months of the current year.
+    """
+    today = today or datetime.now()
+    result = [(year, None) for year in range(first_year, today.year)]
+    first = first_month if first_year == today.year else 1
+    if first_year <= today.year:
+        result += [(today.year, month) for month in range(first, today.month + 1)]
+    return result
+
+
+def job_key(pair, year, month):
+    return f"{pair.upper()}/{period_name(year, month)}"
+
+
+def plan(pairs, today=None, done=None):
+    """
+    Jobs to download the pairs, in order.
+    :param pairs: (pair, first year, first month) tuples, see read_pairs.
+    :param done: Called with (pair, year, month), tells whether the archive is already stored.
+    :return: List of job dicts (key, pair, year, month, status).
+    """
+    jobs = []
+    for pair, first_year, first_month in pairs:
+        for year, month in periods(first_year, first_month, today):
+            stored = done is not None and done(pair, year, month)
+            jobs.append(dict(key=job_key(pair, year, month), pair=pair, year=year, month=month,
+                             status=DONE if stored else PENDING))
+    return jobs
+
+
+def archive_path(output, pair, year, month, platform='ASCII', time_frame='M1', output_format='zip'):
+    """
+    Path of the archive of a period under output/<pair>/, as written by download_hist_data.
+    """
+    name = f'DAT_{platform}_{pair.upper()}_{time_frame}_{period_name(year, month)}.{output_format}'
+    return os.path.join(output, pair.lower(), name)
+
+
+def is_final(path, year, month):
+    """
+    Whether an archive file was written after the end of its period, i.e. cannot be partial.
+    """
+    return os.path.getmtime(path) >= period_end(period_name(year, month)).timestamp()
+
+
+def zip_done(output, platform='ASCII', time_frame='M1', output_format='zip'):
+    """
+    done() for download_all_fx_data.py: the archive file exists under output/<pair>/ and was written
+    after the end of its period (one written while the month was in progress is fetched again).
+    """
+    def done(pair, year, month):
+        path = archive_path(output, pair, year, month, platform, time_frame, output_format)
+        return os.path.exists(path) and is_final(path, year, month)
+
+    return done
+
+
+def delta_done(output):
+    """
+    done() for dt_download.py: the archive ends before the last month stored for the pair in the
+    Delta table. That last month may be incomplete, so it is always fetched again.
+    A pair whose stored bars are all synthetic (histdata.crosses, no native bar found yet) has
+    nothing downloaded.
+    """
+    from deltalake import DeltaTable
+    from histdata.delta import high_water_mark, load_state
+
+    dt = DeltaTable(output) if DeltaTable.is_deltatable(output) else None
+    synthetic = {pair for pair, values in load_state(output, 'crosses').items() if values['native_first'] is None}
+    marks = {}
+    lock = threading.Lock()
+
+    def done(pair, year, month):
+        if dt is None or pair.upper() in synthetic:
+            return False
+        with lock:
+            if pair not in marks:
+                marks[pair] = high_water_mark(dt, pair)
+        last = marks[pair]
+        if last is None:
+            return False
+        if month is None:
+            return year < last.year
+        return (year, month) < (last.year, last.month)
+
+    return done
+
+
+def ran_before_end(job):
+    """
+    Whether a job last ran before the end of its period: the archive it got may have been partial.
+    """
+    return datetime.fromisoformat(job['updated']) < period_end(period_name(job['year'], job['month']))
+
+
+class Manifest:
+    """
+    Jobs of a bulk download and their status, persisted as JSON after every change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.jobs = {job['key']: job for job in json.load(f)['jobs']}
+
+    @classmethod
+    def for_output(cls, output, consumer='delta'):
+        """
+        Manifest of the downloads into output: consumer is 'delta' for dt_download.py, or the output
+        format ('zip', 'parquet') for download_all_fx_data.py.
+        """
+        return cls(os.path.join(output, MANIFEST_DIR, f'plan_{consumer}.json'))
+
+    def update(self, jobs):
+        """
+        Merge a fresh plan into the manifest. The plan decides what is stored: a done job whose data
+        is gone (done() is false) is fetched again. So is a job that ran before the end of its period
+        (the current month, at the time), its archive may be partial. Failed and pending jobs stay to
+        run. Jobs no longer planned (the months of a year now over) are dropped, and the yearly job
+        of a month that never completed is fetched again in its place.
+        """
+        with self._lock:
+            fresh = {job['key']: job for job in jobs}
+            retired = set()
+            for key, previous in list(self.jobs.items()):
+                if key not in fresh:
+                    del self.jobs[key]
+                    if previous['status'] in (PENDING, FAILED):
+                        retired.add(job_key(previous['pair'], previous['year'], None))
+            for job in jobs:
+                previous = self.jobs.get(job['key'])
+                if previous is None or 'updated' not in previous:
+                    # New, or only planned so far: the fresh plan knows better.
+                    self.jobs[job['key']] = dict(previous or {}, **job)
+                elif previous['status'] == DONE and (job['status'] != DONE or ran_before_end(previous)):
+                    previous['status'] = PENDING
+                elif previous['status'] == EMPTY and ran_before_end(previous):
+                    previous['status'] = PENDING
+                elif previous['status'] in (PENDING, FAILED) and job['status'] == DONE:
+                    previous['status'] = DONE
+            for key in retired:
+                if key in self.jobs:
+                    self.jobs[key]['status'] = PENDING
+            self._save()
+
+    def pending(self):
+        return [job for job in self.jobs.values() if job['status'] in (PENDING, FAILED)]
+
+    def counts(self):
+        result = {}
+        for job in self.jobs.values():
+            result[job['status']] = result.get(job['status'], 0) + 1
+        return result
+
+    def mark(self, job, status, error=None):
+        with self._lock:
+            job = self.jobs[job['key']]
+            job['status'] = status
+            job['error'] = error
+            job['attempts'] = job.get('attempts', 0) + 1
+            job['updated'] = datetime.now().isoformat(timespec='seconds')
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        jobs = sorted(self.jobs.values(), key=lambda job: job['key'])
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(dict(jobs=jobs), f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def execute(manifest, run, workers=1):
+    """
+    Run the pending jobs of the manifest. The jobs of a pair run in order, one pair per worker.
+    A failing job is recorded and the next job of the pair runs anyway. A NoArchiveError from
+    download_hist_data means histdata.com has no such archive: the job is marked empty. Any other
+    error (the site being down included) marks it failed, and the next run retries it.
+    :param run: Called with each job dict, downloads its archive.
+    :return: Counts of jobs per status.
+    """
+    by_pair = {}
+    for job in sorted(manifest.pending(), key=lambda job: (job['pair'], job['year'], job['month'] or 0)):
+        by_pair.setdefault(job['pair'], []).append(job)
+    logger.info(f"{sum(len(jobs) for jobs in by_pair.values())} jobs to run for {len(by_pair)} pairs")
+
+    def run_pair(jobs):
+        for job in jobs:
+            try:
+                run(job)
+            except NoArchiveError as e:
+                logger.info(f"No archive for {job['key']}: {e}")
+                manifest.mark(job, EMPTY, str(e))
+            except Exception as e:
+                logger.warning(f"Job {job['key']} failed: {e!r}")
+                manifest.mark(job, FAILED, repr(e))
+            else:
+                manifest.mark(job, DONE)
+
+    run_pool(run_pair, list(by_pair.values()), workers=workers)
+    counts = manifest.counts()
+    logger.info('Jobs: ' + ', '.join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return counts
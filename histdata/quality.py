@@ -0,0 +1,165 @@
+"""
+Data quality checks of the M1 bars, computed per (pair, month) with vectorized NumPy kernels.
+
+A (pair, year) partition is read at a time (date and OHLC columns only) and summarized per month:
+row count, duplicated timestamps, missing minutes outside of the weekend close, OHLC consistency
+violations, zero or negative prices and outlier jumps of the close. The gaps themselves are listed
+in a second table, so they can be inspected or joined against. The last date of the previous
+partition is passed along, so a gap across the new year is found too.
+"""
+import numpy as np
+import pyarrow as pa
+
+from histdata.timezone import from_est
+
+WEEK = 7 * 86400
+# The FX market closes on Friday 17:00 and reopens on Sunday 17:00, New York time.
+# Positions in the week, from Monday 00:00.
+WEEKEND_CLOSE = 4 * 86400 + 17 * 3600
+WEEKEND_OPEN = 6 * 86400 + 17 * 3600
+WEEKEND_CLOSED = WEEKEND_OPEN - WEEKEND_CLOSE
+# The first and last minutes around the close are often missing from the archives.
+WEEKEND_TOLERANCE = 3600
+# 1970-01-01 was a Thursday: Monday 00:00 is 4 days later.
+_MONDAY = 4 * 86400
+
+# A close to close move larger than this many robust standard deviations of the month is an outlier.
+OUTLIER_SIGMAS = 20
+
+SUMMARY_SCHEMA = pa.schema([('month', pa.timestamp('us')),
+                            ('rows', pa.int64()),
+                            ('first', pa.timestamp('us')),
+                            ('last', pa.timestamp('us')),
+                            ('duplicates', pa.int64()),
+                            ('gaps', pa.int64()),
+                            ('missing_minutes', pa.int64()),
+                            ('max_gap_minutes', pa.int64()),
+                            ('ohlc_violations', pa.int64()),
+                            ('non_positive', pa.int64()),
+                            ('outliers', pa.int64()),
+                            ('year', pa.int32()),
+                            ('pair', pa.string())])
+
+GAP_SCHEMA = pa.schema([('start', pa.timestamp('us')),
+                        ('end', pa.timestamp('us')),
+                        ('missing_minutes', pa.int64()),
+                        ('year', pa.int32()),
+                        ('pair', pa.string())])
+
+
+def weekend_gaps(start, end):
+    """
+    Whether each gap (start, end), in EST epoch seconds, is the weekend close.
+    """
+    local = from_est(start, 'America/New_York')
+    position = (local - _MONDAY) % WEEK
+    reopen = local - position + WEEKEND_OPEN
+    return ((position >= WEEKEND_CLOSE - WEEKEND_TOLERANCE) &
+            (from_est(end, 'America/New_York') <= reopen + WEEKEND_TOLERANCE))
+
+
+def _closed_before(local):
+    """
+    Seconds of weekend close between Monday 1970-01-05 00:00 and each local time.
+    """
+    weeks, position = np.divmod(local - _MONDAY, WEEK)
+    return weeks * WEEKEND_CLOSED + np.clip(position - WEEKEND_CLOSE, 0, WEEKEND_CLOSED)
+
+
+def closed_minutes(start, end):
+    """
+    Minutes of weekend close within each gap (start, end), in EST epoch seconds: a gap that runs
+    over a weekend only misses the minutes the market was open.
+    """
+    local_start, local_end = from_est(start, 'America/New_York'), from_est(end, 'America/New_York')
+    closed = _closed_before(local_end) - _closed_before(local_start)
+    # Clocks change on Sunday 2:00, while the market is closed: that weekend is an hour shorter or longer.
+    closed -= (local_end - local_start) - (end - start)
+    return closed // 60
+
+
+def outliers(close, sigmas=OUTLIER_SIGMAS):
+    """
+    Mask of the bars whose close moved more than `sigmas` robust standard deviations
+    (1.4826 * median absolute deviation of the log returns) from the previous close.
+    """
+    mask = np.zeros(len(close), dtype=bool)
+    if len(close) < 3:
+        return mask
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.diff(np.log(close))
+    finite = np.isfinite(returns)
+    if not finite.any():
+        return mask
+    deviation = np.abs(returns - np.median(returns[finite]))
+    scale = 1.4826 * np.median(deviation[finite])
+    if scale == 0:
+        return mask
+    mask[1:] = finite & (deviation > sigmas * scale)
+    return mask
+
+
+def _per_month(keys, months, values):
+    return np.bincount(np.searchsorted(months, keys), weights=values, minlength=len(months)).astype(np.int64)
+
+
+def scan(seconds, open, high, low, close, pair, sigmas=OUTLIER_SIGMAS, previous=None):
+    """
+    Quality summary of the M1 bars of one pair, sorted by date.
+    :param seconds: int64 EST epoch seconds.
+    :param previous: EST epoch seconds of the last bar before these (the end of the previous partition),
+                     if any. A gap from it to the first bar is attributed to the first month.
+    :return: (summary, gaps) Arrow tables matching SUMMARY_SCHEMA and GAP_SCHEMA.
+    """
+    pair = pair.upper()
+    month_of = seconds.astype('datetime64[s]').astype('datetime64[M]')
+    months, first_index, rows = np.unique(month_of, return_index=True, return_counts=True)
+    last_index = first_index + rows - 1
+
+    step = np.diff(seconds)
+    duplicate = np.concatenate(([False], step == 0))
+    # A gap between two bars is attributed to the month of the bar before it.
+    gap = np.flatnonzero(step > 60)
+    gap_start, gap_end, gap_month = seconds[gap], seconds[gap + 1], month_of[gap]
+    if previous is not None and len(seconds) and seconds[0] - previous > 60:
+        gap_start = np.concatenate(([previous], gap_start))
+        gap_end = np.concatenate((seconds[:1], gap_end))
+        gap_month = np.concatenate((month_of[:1], gap_month))
+    keep = ~weekend_gaps(gap_start, gap_end)
+    gap_start, gap_end, gap_month = gap_start[keep], gap_end[keep], gap_month[keep]
+    missing = np.maximum((gap_end - gap_start) // 60 - 1 - closed_minutes(gap_start, gap_end), 0)
+
+    violation = ((high < low) | (high < np.maximum(open, close)) | (low > np.minimum(open, close)))
+    non_positive = (open <= 0) | (high <= 0) | (low <= 0) | (close <= 0)
+    jumps = np.zeros(len(close), dtype=bool)
+    for start, count in zip(first_index, rows):
+        jumps[start:start + count] = outliers(close[start:start + count], sigmas)
+
+    max_gap = np.zeros(len(months), dtype=np.int64)
+    np.maximum.at(max_gap, np.searchsorted(months, gap_month), missing)
+
+    month_dates = pa.array(months.astype('datetime64[us]'))
+    summary = pa.Table.from_arrays([
+        month_dates,
+        pa.array(rows.astype(np.int64)),
+        pa.array(seconds[first_index].astype('datetime64[s]').astype('datetime64[us]')),
+        pa.array(seconds[last_index].astype('datetime64[s]').astype('datetime64[us]')),
+        pa.array(_per_month(month_of, months, duplicate)),
+        pa.array(_per_month(gap_month, months, np.ones(len(gap_start)))),
+        pa.array(_per_month(gap_month, months, missing)),
+        pa.array(max_gap),
+        pa.array(_per_month(month_of, months, violation)),
+        pa.array(_per_month(month_of, months, non_positive)),
+        pa.array(_per_month(month_of, months, jumps)),
+        pa.array(months.astype('datetime64[Y]').astype(np.int32) + 1970),
+        pa.repeat(pair, len(months)),
+    ], schema=SUMMARY_SCHEMA)
+
+    gaps = pa.Table.from_arrays([
+        pa.array(gap_start.astype('datetime64[s]').astype('datetime64[us]')),
+        pa.array(gap_end.astype('datetime64[s]').astype('datetime64[us]')),
+        pa.array(missing),
+        pa.array(gap_month.astype('datetime64[Y]').astype(np.int32) + 1970),
+        pa.repeat(pair, len(gap_start)),
+    ], schema=GAP_SCHEMA)
+    return summary, gaps
@@ -0,0 +1,136 @@
+"""
+Read API over the Delta tables written by dt_download.py and dt_resample.py.
+
+A query only touches the files that can hold matching rows: the pair and year partitions and
+the min/max date statistics of each file, both kept in the Delta log, are used to prune files
+before anything is read. Within the remaining files, only the requested columns are decoded
+and pyarrow filters the rows on date.
+"""
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from deltalake import DeltaTable
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def table_uri(timeframe='M1', output=None):
+    """
+    Location of the Delta table of a timeframe: FX_DATA_OUTPUT for M1, FX_DATA_OUTPUT_<timeframe> otherwise.
+    """
+    output = output or os.environ.get("FX_DATA_OUTPUT", 'output')
+    return output if timeframe == 'M1' else f"{output}_{timeframe}"
+
+
+def open_table(uri):
+    """
+    DeltaTable at uri, shared between queries. Each call brings it up to date by reading only
+    the log entries committed since the previous call.
+    """
+    with _tables_lock:
+        dt = _tables.get(uri)
+        if dt is None:
+            dt = _tables[uri] = DeltaTable(uri)
+        else:
+            dt.update_incremental()
+        return dt
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return np.datetime64(value if not isinstance(value, datetime) else value.replace(tzinfo=None), 'us')
+
+
+def _pruning_predicate(pairs, start, end):
+    """
+    SQL predicate on the partition columns and the date statistics, evaluated on the Delta log.
+    """
+    terms = ["pair IN ({})".format(', '.join(f"'{p}'" for p in pairs))]
+    if start is not None:
+        terms += [f"year >= {start.astype('datetime64[Y]').astype(int) + 1970}", f"date >= '{start}'"]
+    if end is not None:
+        terms += [f"year <= {end.astype('datetime64[Y]').astype(int) + 1970}", f"date < '{end}'"]
+    return ' AND '.join(terms)
+
+
+def _row_filter(pairs, start, end):
+    condition = ds.field('pair').isin(pairs)
+    if start is not None:
+        condition &= ds.field('date') >= pa.scalar(start, pa.timestamp('us'))
+    if end is not None:
+        condition &= ds.field('date') < pa.scalar(end, pa.timestamp('us'))
+    return condition
+
+
+def _prune(files, pairs, start, end):
+    """
+    Rows of a manifest (see histdata.catalog) that may hold rows of the pairs in [start, end).
+    """
+    keep = pc.is_in(files['partition.pair'], pa.array(pairs))
+    for bound, year, stat, compare in ((start, pc.greater_equal, 'max.date', pc.greater_equal),
+                                       (end, pc.less_equal, 'min.date', pc.less)):
+        if bound is None:
+            continue
+        keep = pc.and_(keep, year(files['partition.year'], int(bound.astype('datetime64[Y]').astype(int)) + 1970))
+        if stat in files.column_names:
+            within = compare(files[stat], pa.scalar(bound, files.schema.field(stat).type))
+            keep = pc.and_(keep, pc.fill_null(within, True))
+    return files.filter(keep)
+
+
+def dataset(pairs, start=None, end=None, timeframe='M1', output=None, version=None):
+    """
+    pyarrow Dataset of the files that may hold rows of the pairs in [start, end), and the row filter.
+    :param version: Read this version of the table, or the version pinned under this name (see
+                    histdata.catalog.pin): the files are listed from its cached manifest.
+    """
+    pairs = [pairs.upper()] if isinstance(pairs, str) else [p.upper() for p in pairs]
+    start, end = _timestamp(start), _timestamp(end)
+    uri = table_uri(timeframe, output)
+    if version is not None:
+        from histdata.catalog import snapshot
+
+        snap = snapshot(uri, name=version) if isinstance(version, str) else snapshot(uri, version=version)
+        return (snap.to_pyarrow_dataset(files=_prune(snap.get_add_actions(), pairs, start, end)),
+                _row_filter(pairs, start, end))
+    dt = open_table(uri)
+    return (dt.to_pyarrow_dataset(file_pruning_predicate=_pruning_predicate(pairs, start, end)),
+            _row_filter(pairs, start, end))
+
+
+def iter_batches(pairs, start=None, end=None, columns=None, timeframe='M1', output=None, batch_size=128 * 1024,
+                 version=None):
+    """
+    Record batches of the bars of the pairs with start <= date < end, one file at a time.
+    Batches come in file order, not sorted by date.
+    :param pairs: Pair or list of pairs. Example: 'eurusd'.
+    :param start: First date (datetime, numpy.datetime64 or ISO string), EST. None: from the first bar.
+    :param end: Date after the last bar, EST. None: up to the last bar.
+    :param columns: Columns to read (default: all).
+    :param timeframe: M1 or one of the timeframes materialized by dt_resample.py.
+    :param output: Location of the M1 table (default: FX_DATA_OUTPUT).
+    :param version: Version of the table, or name of a pinned version (default: the current version).
+    """
+    source, condition = dataset(pairs, start, end, timeframe, output, version)
+    yield from source.to_batches(columns=columns, filter=condition, batch_size=batch_size)
+
+
+def load(pairs, start=None, end=None, columns=None, timeframe='M1', output=None, as_pandas=False, version=None):
+    """
+    Bars of the pairs with start <= date < end, sorted by pair and date.
+    Same arguments as iter_batches.
+    :param as_pandas: Return a pandas DataFrame instead of a pyarrow Table.
+    """
+    source, condition = dataset(pairs, start, end, timeframe, output, version)
+    table = source.to_table(columns=columns, filter=condition)
+    keys = [(name, 'ascending') for name in ('pair', 'date') if name in table.column_names]
+    if keys and table.num_rows:
+        table = table.sort_by(keys)
+    return table.to_pandas() if as_pandas else table
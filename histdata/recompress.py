@@ -0,0 +1,184 @@
+"""
+Recompression of the DAT_{platform}_{PAIR}_{time_frame}_{period}.zip archives written by download_hist_data.
+
+Each archive is rewritten member by member, streamed from the old archive into a temporary
+file next to it, which then atomically replaces the old archive: nothing is extracted to disk
+and a crash never leaves a half written archive behind. Besides a tighter ZIP, an archive can
+be turned into a zstd compressed CSV or into a typed Parquet file (see histdata.parquet).
+"""
+import os
+import re
+import shutil
+import tempfile
+import time
+from zipfile import ZIP_BZIP2, ZIP_DEFLATED, ZIP_LZMA, ZipFile, ZipInfo
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from histdata.ingest import open_csv_member
+from histdata.parquet import write_parquet
+
+ARCHIVE_NAME = re.compile(r'^DAT_(?P<platform>[A-Z]+)_(?P<pair>[A-Z0-9]+)_'
+                          r'(?P<time_frame>M1|T|T_LAST|T_BID|T_ASK)_(?P<period>\d{4}|\d{6})\.zip$')
+
+# Output formats: extension of the file replacing the archive.
+FORMATS = {'zip': '.zip',
+           'csv.zst': '.csv.zst',
+           'parquet': '.parquet'}
+
+ZIP_METHODS = {'deflate': ZIP_DEFLATED,
+               'bzip2': ZIP_BZIP2,
+               'lzma': ZIP_LZMA}
+
+COPY_CHUNK_SIZE = 1 << 20
+ZSTD_FRAME_SIZE = 16 << 20
+
+
+def parse_archive_name(path):
+    """
+    Fields of an archive name (platform, pair, time_frame, period), or None if it is not a histdata archive.
+    """
+    match = ARCHIVE_NAME.match(os.path.basename(path))
+    return match.groupdict() if match else None
+
+
+def find_archives(root):
+    """
+    Histdata archives under root (a pair directory or the output directory holding them), sorted.
+    """
+    found = []
+    for directory, _, files in os.walk(root):
+        found += [os.path.join(directory, f) for f in files if ARCHIVE_NAME.match(f)]
+    return sorted(found)
+
+
+def replace_atomically(path, write, source=None):
+    """
+    Call write(tmp) on a temporary file in the directory of path, then move it over path.
+    :param source: Give the new file the permissions of this file (default: 0o644).
+    :return: What write returned.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        result = write(tmp)
+        if source is None:
+            os.chmod(tmp, 0o644)
+        else:
+            shutil.copymode(source, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return result
+
+
+def recompress_zip(src, dst, method='deflate', level=9):
+    """
+    Copy every member of the src archive into a new dst archive with another compression.
+    """
+    with ZipFile(src, 'r') as r, ZipFile(dst, 'w', ZIP_METHODS[method], compresslevel=level) as w:
+        for info in r.infolist():
+            target = ZipInfo(info.filename, date_time=info.date_time)
+            target.compress_type = ZIP_METHODS[method]
+            # ZipFile.open only applies its compresslevel to the members it names itself.
+            target.compress_level = level
+            target.external_attr = info.external_attr
+            with r.open(info) as i, w.open(target, 'w', force_zip64=True) as o:
+                shutil.copyfileobj(i, o, COPY_CHUNK_SIZE)
+
+
+def zip_to_zstd_csv(src, dst, level=19, frame_size=ZSTD_FRAME_SIZE):
+    """
+    Stream the CSV member of the src archive into a zstd compressed file, one frame per
+    frame_size bytes of CSV (a multi-frame file decompresses like a single one).
+    """
+    codec = pa.Codec('zstd', compression_level=level)
+    with ZipFile(src, 'r') as r:
+        member = open_csv_member(r)
+        if member is None:
+            raise ValueError(f'{src} has no CSV member.')
+        with member, open(dst, 'wb') as o:
+            for chunk in iter(lambda: member.read(frame_size), b''):
+                o.write(codec.compress(chunk, asbytes=True))
+
+
+def read_seconds(path):
+    """
+    Seconds taken to read back all the data of an archive, zstd compressed CSV or Parquet file.
+    """
+    start = time.perf_counter()
+    if path.endswith('.zip'):
+        with ZipFile(path, 'r') as r:
+            for info in r.infolist():
+                with r.open(info) as i:
+                    while i.read(COPY_CHUNK_SIZE):
+                        pass
+    elif path.endswith('.csv.zst'):
+        with pa.input_stream(path, compression='zstd') as i:
+            while i.read(COPY_CHUNK_SIZE):
+                pass
+    else:
+        pq.read_table(path)
+    return time.perf_counter() - start
+
+
+def recompress_archive(path, output_format='zip', method='deflate', level=None, keep=False,
+                       price_type='float64'):
+    """
+    Recompress one archive in place. Runs in a worker process.
+    :param output_format: One of FORMATS. For 'csv.zst' and 'parquet', the archive is removed once
+                          the new file is in place (unless keep=True).
+    :param method: ZIP compression of the 'zip' output, one of ZIP_METHODS.
+    :param level: Compression level (default: 9 for ZIP, 19 for zstd).
+    :param price_type: Type of the prices of the 'parquet' output, one of histdata.parquet.PRICE_TYPES.
+    :return: Report with the pair, the sizes before and after, the seconds taken to read the data
+             back before and after, and the seconds spent recompressing.
+    """
+    fields = parse_archive_name(path)
+    if fields is None:
+        raise ValueError(f'{path} is not a histdata archive name.')
+    if output_format not in FORMATS:
+        raise ValueError(f'Unknown output format: {output_format}')
+    before = os.path.getsize(path)
+    read_before = read_seconds(path)
+    start = time.perf_counter()
+    if level is None:
+        level = 19 if output_format == 'csv.zst' else 9
+    target = path[:-len('.zip')] + FORMATS[output_format]
+    if output_format == 'zip':
+        replace_atomically(target, lambda tmp: recompress_zip(path, tmp, method, level), path)
+    elif output_format == 'csv.zst':
+        replace_atomically(target, lambda tmp: zip_to_zstd_csv(path, tmp, level=level), path)
+    elif output_format == 'parquet':
+        if fields['platform'] != 'ASCII':
+            raise ValueError(f'Parquet output needs ASCII archives, not {fields["platform"]}: {path}')
+        replace_atomically(target, lambda tmp: write_parquet(path, tmp, fields['pair'], fields['time_frame'],
+                                                             price_type), path)
+    seconds = time.perf_counter() - start
+    if target != path and not keep:
+        os.remove(path)
+    return dict(path=path, output=target, pair=fields['pair'], bytes_before=before,
+                bytes_after=os.path.getsize(target), read_seconds_before=read_before,
+                read_seconds_after=read_seconds(target), seconds=seconds)
+
+
+def summarize(reports):
+    """
+    Totals per pair: archives, bytes and read seconds before and after, bytes and read seconds saved,
+    and seconds of work.
+    """
+    pairs = {}
+    for report in reports:
+        total = pairs.setdefault(report['pair'], dict(pair=report['pair'], archives=0, bytes_before=0,
+                                                      bytes_after=0, read_seconds_before=0.0,
+                                                      read_seconds_after=0.0, seconds=0.0))
+        total['archives'] += 1
+        for field in ('bytes_before', 'bytes_after', 'read_seconds_before', 'read_seconds_after', 'seconds'):
+            total[field] += report[field]
+    for total in pairs.values():
+        total['bytes_saved'] = total['bytes_before'] - total['bytes_after']
+        total['read_seconds_saved'] = total['read_seconds_before'] - total['read_seconds_after']
+    return [pairs[p] for p in sorted(pairs)]
@@ -0,0 +1,188 @@
+"""
+Resampling of the M1 bars of the Delta table into higher timeframes (M5, M15, H1, D1, ...).
+
+Bars are aggregated in a single pass over the (pair, year) partitions. Each partition is
+reduced with NumPy (first/max/min/last per bucket), and the last bucket of a partition is
+carried over to the next one, so buckets spanning a year boundary come out whole.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from deltalake import DeltaTable
+
+from histdata.delta import high_water_mark, pair_files, partition_filters
+from histdata.ingest import M1_SCHEMA, write_delta
+from histdata.log import get_project_logger
+from histdata.timezone import from_est
+
+logger = get_project_logger(__name__)
+
+TIMEFRAMES = {'M1': 60,
+              'M5': 5 * 60,
+              'M15': 15 * 60,
+              'M30': 30 * 60,
+              'H1': 3600,
+              'H4': 4 * 3600,
+              'D1': 86400}
+
+# A session aligns buckets on the local time of a market: (IANA zone, offset of the bucket start).
+# 'new_york' starts each day at 17:00 New York time (the FX daily close), following its DST.
+Session = namedtuple('Session', ['tz', 'offset'])
+SESSIONS = {'est': Session(None, 0),
+            'new_york': Session('America/New_York', 17 * 3600)}
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+
+Bars = namedtuple('Bars', ['start', 'open', 'high', 'low', 'close'])
+
+
+def bucket_keys(seconds, width, session=SESSIONS['est']):
+    """
+    Start of the bucket of every timestamp.
+    :param seconds: int64 EST epoch seconds, sorted.
+    :param width: Bucket width in seconds.
+    :param session: Buckets are aligned on this session's local time, and labelled with it.
+    """
+    if session.tz is not None:
+        seconds = from_est(seconds, session.tz)
+    return (seconds - session.offset) // width * width + session.offset
+
+
+def aggregate(keys, open, high, low, close):
+    """
+    OHLC of consecutive runs of equal keys.
+    :return: Bars, one entry per run.
+    """
+    if len(keys) == 0:
+        return _empty()
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    ends = np.concatenate((starts[1:], [len(keys)])) - 1
+    return Bars(keys[starts],
+                open[starts],
+                np.maximum.reduceat(high, starts),
+                np.minimum.reduceat(low, starts),
+                close[ends])
+
+
+def _empty():
+    return Bars(np.empty(0, np.int64), *(np.empty(0, np.float64) for _ in PRICE_COLUMNS))
+
+
+def _concat(a, b):
+    return Bars(*(np.concatenate((x, y)) for x, y in zip(a, b)))
+
+
+class Resampler:
+    """
+    Streaming resampler of M1 bars of one pair. Feed it batches sorted by date with update(),
+    in order, and call flush() at the end. The last bucket is held back until a later batch
+    (or flush) shows it is complete.
+    """
+
+    def __init__(self, timeframe, session='est'):
+        self.width = TIMEFRAMES[timeframe] if isinstance(timeframe, str) else int(timeframe)
+        self.session = SESSIONS[session] if isinstance(session, str) else session
+        self._pending = None
+
+    def update(self, seconds, open, high, low, close):
+        """
+        :param seconds: int64 EST epoch seconds, sorted, all later than the previous batch.
+        :return: Bars completed by this batch.
+        """
+        bars = aggregate(bucket_keys(seconds, self.width, self.session), open, high, low, close)
+        if self._pending is not None:
+            pending = self._pending
+            if len(bars.start) and bars.start[0] == pending.start[0]:
+                # The carried bucket continues in this batch.
+                bars = bars._replace(open=bars.open.copy(), high=bars.high.copy(), low=bars.low.copy())
+                bars.open[0] = pending.open[0]
+                bars.high[0] = max(bars.high[0], pending.high[0])
+                bars.low[0] = min(bars.low[0], pending.low[0])
+            else:
+                bars = _concat(pending, bars)
+        if len(bars.start) == 0:
+            self._pending = None
+            return bars
+        self._pending = Bars(*(a[-1:] for a in bars))
+        return Bars(*(a[:-1] for a in bars))
+
+    def flush(self):
+        bars, self._pending = self._pending, None
+        return _empty() if bars is None else bars
+
+
+def to_arrow(bars, pair):
+    """
+    Bars as an Arrow table in the layout of the M1 table (date, OHLC, year, pair).
+    """
+    date = pa.array(bars.start.astype('datetime64[s]')).cast(pa.timestamp('us'))
+    return pa.Table.from_arrays([date,
+                                 pa.array(bars.open), pa.array(bars.high),
+                                 pa.array(bars.low), pa.array(bars.close),
+                                 pc.year(date).cast(pa.int32()),
+                                 pa.repeat(pair.upper(), len(bars.start))],
+                                schema=M1_SCHEMA)
+
+
+def read_partition(dt, pair, year):
+    """
+    M1 bars of one (pair, year) partition, sorted by date, as NumPy arrays (seconds, open, high, low, close).
+    """
+    table = dt.to_pyarrow_table(partitions=partition_filters(pair, year), columns=['date'] + PRICE_COLUMNS)
+    table = table.sort_by('date')
+    seconds = table['date'].cast(pa.timestamp('s')).cast(pa.int64()).to_numpy()
+    return (seconds,) + tuple(table[c].to_numpy() for c in PRICE_COLUMNS)
+
+
+def years(dt, pair, first_year=None):
+    files = pair_files(dt, pair)
+    result = sorted(set(files['partition.year'].to_pylist()))
+    return [y for y in result if first_year is None or y >= first_year]
+
+
+def resample_pair(dt, pair, timeframe, session='est', first_year=None):
+    """
+    Resample the M1 bars of a pair, one year partition at a time.
+    :param dt: DeltaTable of M1 bars.
+    :param first_year: Skip the partitions before this year.
+    :return: Iterator of Arrow tables of bars, in date order.
+    """
+    pair = pair.upper()
+    resampler = Resampler(timeframe, session)
+    for year in years(dt, pair, first_year):
+        bars = resampler.update(*read_partition(dt, pair, year))
+        if len(bars.start):
+            yield to_arrow(bars, pair)
+    bars = resampler.flush()
+    if len(bars.start):
+        yield to_arrow(bars, pair)
+
+
+def materialize(source, target, pair, timeframe, session='est'):
+    """
+    Write the resampled bars of a pair to the Delta table at `target`, partitioned like the M1 table.
+    Only the bars from the last bar already in `target` onwards are recomputed and upserted,
+    so calling it again after new months land in `source` is cheap.
+    :return: Number of bars written.
+    """
+    pair = pair.upper()
+    dt = DeltaTable(source)
+    last = high_water_mark(DeltaTable(target), pair) if DeltaTable.is_deltatable(target) else None
+    first_year = None
+    if last is not None:
+        # The last bar may hold data from the previous EST year when the session is ahead of EST.
+        first_year = (np.datetime64(last, 's') - np.timedelta64(1, 'D')).astype('datetime64[Y]').astype(int) + 1970
+        last = np.datetime64(last, 'us')
+
+    written = 0
+    for bars in resample_pair(dt, pair, timeframe, session, first_year):
+        if last is not None:
+            bars = bars.filter(pc.greater_equal(bars['date'], pa.scalar(last, pa.timestamp('us'))))
+        for year in pc.unique(bars['year']).to_pylist():
+            part = bars.filter(pc.equal(bars['year'], year))
+            write_delta(target, part, pair, year, mode='merge')
+            written += part.num_rows
+    logger.info(f"Wrote {written} {timeframe} bars for {pair} to {target}")
+    return written
@@ -0,0 +1,187 @@
+"""
+Streaming ingest of tick archives (TimeFrame.TICK_DATA*) into Delta tables.
+
+An archive is parsed once, in record batches. Each batch is appended to a tick table
+(date, bid, ask, last, year, pair) and fed to per-side resamplers, so the bid/ask/mid OHLC
+and spread bars come out of the same pass without the month ever being held in memory.
+"""
+from zipfile import ZipFile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+from deltalake import DeltaTable, write_deltalake
+
+from histdata.ingest import BLOCK_SIZE, open_csv_member, write_delta
+from histdata.resample import Resampler
+from histdata.timezone import TIMESTAMP_WIDTH, parse_timestamps
+
+# Layout of the CSV member for each tick time frame (the values of histdata.api.TimeFrame).
+# ASCII ticks: '20190601 170000123,1.11900,1.11910,0' (millisecond timestamps, bid and ask).
+# NinjaTrader ticks: '20190601 170000;1.11900;1' (second timestamps, one price).
+TICK_FORMATS = {'T': dict(delimiter=',', columns=['date', 'bid', 'ask', 'volume']),
+                'T_BID': dict(delimiter=';', columns=['date', 'bid', 'volume']),
+                'T_ASK': dict(delimiter=';', columns=['date', 'ask', 'volume']),
+                'T_LAST': dict(delimiter=';', columns=['date', 'last', 'volume'])}
+
+PRICE_SIDES = ['bid', 'ask', 'last']
+BAR_SIDES = ['bid', 'ask', 'mid', 'last', 'spread']
+OHLC = ['open', 'high', 'low', 'close']
+
+TICK_SCHEMA = pa.schema([('date', pa.timestamp('ms')),
+                         ('bid', pa.float64()),
+                         ('ask', pa.float64()),
+                         ('last', pa.float64()),
+                         ('year', pa.int32()),
+                         ('pair', pa.string())])
+
+TICK_BAR_SCHEMA = pa.schema([('date', pa.timestamp('us'))] +
+                            [(f'{side}_{field}', pa.float64()) for side in BAR_SIDES for field in OHLC] +
+                            [('year', pa.int32()),
+                             ('pair', pa.string())])
+
+
+def timestamp_millis(dates):
+    """
+    Parse 'YYYYMMDD HHMMSS' or 'YYYYMMDD HHMMSSNNN' strings to int64 EST epoch milliseconds.
+    :param dates: pyarrow string array, all values the same width.
+    """
+    n = len(dates)
+    if n == 0:
+        return np.empty(0, np.int64)
+    offsets = np.frombuffer(dates.buffers()[1], dtype=np.int32)[dates.offset:dates.offset + n + 1]
+    width = int(offsets[1] - offsets[0])
+    if width not in (TIMESTAMP_WIDTH, TIMESTAMP_WIDTH + 3) or offsets[-1] - offsets[0] != width * n:
+        raise ValueError('Tick timestamps are expected as YYYYMMDD HHMMSS[NNN].')
+    digits = np.frombuffer(dates.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]].reshape(n, width)
+    millis = parse_timestamps(digits[:, :TIMESTAMP_WIDTH]) * 1000
+    if width > TIMESTAMP_WIDTH:
+        ms = digits[:, TIMESTAMP_WIDTH:].astype(np.int64) - ord('0')
+        millis += ms[:, 0] * 100 + ms[:, 1] * 10 + ms[:, 2]
+    return millis
+
+
+def tick_batches(file, pair, time_frame, block_size=BLOCK_SIZE):
+    """
+    Parse the CSV member of a tick archive into record batches matching TICK_SCHEMA.
+    :param file: Path or binary file object of the ZIP archive.
+    :param time_frame: One of the keys of TICK_FORMATS.
+    """
+    fmt = TICK_FORMATS[time_frame]
+    prices = [c for c in fmt['columns'] if c in PRICE_SIDES]
+    pair = pair.upper()
+    with ZipFile(file, 'r') as zip_file:
+        member = open_csv_member(zip_file)
+        if member is None:
+            return
+        with member:
+            reader = pcsv.open_csv(
+                member,
+                read_options=pcsv.ReadOptions(column_names=fmt['columns'], block_size=block_size),
+                parse_options=pcsv.ParseOptions(delimiter=fmt['delimiter']),
+                convert_options=pcsv.ConvertOptions(
+                    column_types=dict({'date': pa.string()}, **{p: pa.float64() for p in prices}),
+                    include_columns=['date'] + prices))
+            for batch in reader:
+                millis = timestamp_millis(batch.column('date'))
+                date = pa.array(millis.astype('datetime64[ms]'))
+                columns = [date]
+                for side in PRICE_SIDES:
+                    columns.append(batch.column(side) if side in prices else pa.nulls(batch.num_rows, pa.float64()))
+                columns += [pc.year(date).cast(pa.int32()), pa.repeat(pair, batch.num_rows)]
+                yield pa.record_batch(columns, schema=TICK_SCHEMA)
+
+
+class TickBars:
+    """
+    Builds OHLC bars per price side (bid, ask, mid, last) and of the spread from tick batches.
+    Sides the archive does not have are left null.
+    """
+
+    def __init__(self, pair, timeframe='M1', session='est'):
+        self.pair = pair.upper()
+        self.timeframe = timeframe
+        self.session = session
+        self._resamplers = {}
+        self._bars = []
+
+    def _side_prices(self, batch):
+        prices = {}
+        for side in PRICE_SIDES:
+            column = batch.column(side)
+            if column.null_count < len(column):
+                prices[side] = column.to_numpy(zero_copy_only=False)
+        if 'bid' in prices and 'ask' in prices:
+            prices['mid'] = (prices['bid'] + prices['ask']) / 2
+            prices['spread'] = prices['ask'] - prices['bid']
+        return prices
+
+    def update(self, batch):
+        """
+        Feed a TICK_SCHEMA batch, sorted by date and later than the previous ones.
+        """
+        seconds = batch.column('date').cast(pa.int64()).to_numpy() // 1000
+        for side, price in self._side_prices(batch).items():
+            resampler = self._resamplers.setdefault(side, Resampler(self.timeframe, self.session))
+            self._bars.append((side, resampler.update(seconds, price, price, price, price)))
+
+    def table(self):
+        """
+        Flush the resamplers and return all the bars as a TICK_BAR_SCHEMA table.
+        """
+        for side, resampler in self._resamplers.items():
+            self._bars.append((side, resampler.flush()))
+        by_side = {}
+        for side, bars in self._bars:
+            by_side.setdefault(side, []).append(bars)
+        self._bars = []
+        if not by_side:
+            return TICK_BAR_SCHEMA.empty_table()
+
+        # Every side sees the same ticks, so the buckets line up across sides.
+        sides = {side: [np.concatenate(values) for values in zip(*parts)] for side, parts in by_side.items()}
+        start = next(iter(sides.values()))[0]
+        date = pa.array(start.astype('datetime64[s]')).cast(pa.timestamp('us'))
+        columns = [date]
+        for side in BAR_SIDES:
+            for i in range(len(OHLC)):
+                columns.append(pa.array(sides[side][i + 1]) if side in sides else pa.nulls(len(start), pa.float64()))
+        columns += [pc.year(date).cast(pa.int32()), pa.repeat(self.pair, len(start))]
+        return pa.Table.from_arrays(columns, schema=TICK_BAR_SCHEMA)
+
+
+def ingest_ticks(file, pair, time_frame, ticks_directory, bars_directory, period=None,
+                 bars_timeframe='M1', write_mode='append', block_size=BLOCK_SIZE):
+    """
+    Write a tick archive to the tick table and its bars to the bar table, parsing it once.
+    :param period: (start, end) datetimes covered by the archive. With write_mode='merge', the
+                   ticks of the pair in that period are replaced instead of appended, and the bars
+                   are upserted, so ingesting the same month twice does not duplicate it.
+    :return: Number of ticks and number of bars written.
+    """
+    bars = TickBars(pair, bars_timeframe)
+    count = 0
+
+    def batches():
+        nonlocal count
+        for batch in tick_batches(file, pair, time_frame, block_size):
+            # A month is sorted in the archive, the batches come in order.
+            bars.update(batch)
+            count += batch.num_rows
+            yield batch
+
+    reader = pa.RecordBatchReader.from_batches(TICK_SCHEMA, batches())
+    if write_mode == 'merge' and period is not None and DeltaTable.is_deltatable(ticks_directory):
+        start, end = period
+        predicate = (f"pair = '{pair.upper()}' AND year = {start.year} "
+                     f"AND date >= '{start:%Y-%m-%d %H:%M:%S}' AND date < '{end:%Y-%m-%d %H:%M:%S}'")
+        write_deltalake(ticks_directory, reader, mode='overwrite', predicate=predicate,
+                        partition_by=['pair', 'year'])
+    else:
+        write_deltalake(ticks_directory, reader, mode='append', partition_by=['pair', 'year'])
+
+    table = bars.table()
+    for year in pc.unique(table['year']).to_pylist():
+        write_delta(bars_directory, table.filter(pc.equal(table['year'], year)), pair, year, mode=write_mode)
+    return count, table.num_rows
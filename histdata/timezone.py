@@ -0,0 +1,134 @@
+"""
+Vectorized conversion of histdata timestamps out of EST.
+
+histdata timestamps are written as 'YYYYMMDD HHMMSS' in Eastern Standard Time *without*
+daylight saving adjustments, i.e. a fixed UTC-5 offset. Every line of a histdata CSV
+starts with such a timestamp, so a whole block of CSV can be converted by rewriting the
+first 15 bytes of each line in place with NumPy, without splitting the lines in Python.
+"""
+import numpy as np
+
+TIMESTAMP_WIDTH = 15  # len('YYYYMMDD HHMMSS')
+EST_UTC_OFFSET = -5 * 3600  # seconds
+BLOCK_SIZE = 16 << 20
+
+_NEWLINE = ord('\n')
+_ZERO = ord('0')
+_SPACE = ord(' ')
+_DIGIT_COLUMNS = [i for i in range(TIMESTAMP_WIDTH) if i != 8]
+
+
+def parse_timestamps(digits):
+    """
+    Parse 'YYYYMMDD HHMMSS' timestamps.
+    :param digits: uint8 array of shape (n, 15) holding the timestamp characters.
+    :return: int64 array of seconds since 1970-01-01 00:00:00 (in the timestamps' own time zone).
+    :raises ValueError: If a row is not in that layout (e.g. a MetaTrader 'YYYY.MM.DD,HH:MM' row).
+    """
+    d = digits.astype(np.int64) - _ZERO
+    valid = ((d[:, _DIGIT_COLUMNS] >= 0) & (d[:, _DIGIT_COLUMNS] <= 9)).all(axis=1) & (digits[:, 8] == _SPACE)
+    if not valid.all():
+        row = digits[np.argmin(valid)].tobytes()
+        raise ValueError(f"Timestamp {row!r} does not match 'YYYYMMDD HHMMSS'.")
+    year = d[:, 0] * 1000 + d[:, 1] * 100 + d[:, 2] * 10 + d[:, 3]
+    month = d[:, 4] * 10 + d[:, 5]
+    day = d[:, 6] * 10 + d[:, 7]
+    months = (year - 1970) * 12 + month - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + day - 1
+    seconds = (d[:, 9] * 10 + d[:, 10]) * 3600 + (d[:, 11] * 10 + d[:, 12]) * 60 + d[:, 13] * 10 + d[:, 14]
+    return days * 86400 + seconds
+
+
+def format_timestamps(seconds):
+    """
+    Inverse of parse_timestamps.
+    :return: uint8 array of shape (n, 15) holding 'YYYYMMDD HHMMSS' characters.
+    """
+    days, seconds = np.divmod(seconds, 86400)
+    months = days.astype('datetime64[D]').astype('datetime64[M]')
+    day = days - months.astype('datetime64[D]').astype(np.int64) + 1
+    months = months.astype(np.int64)
+    year, month = np.divmod(months, 12)
+    year += 1970
+    month += 1
+    hour, seconds = np.divmod(seconds, 3600)
+    minute, second = np.divmod(seconds, 60)
+
+    out = np.empty((len(days), TIMESTAMP_WIDTH), dtype=np.uint8)
+    for col, (value, width) in zip((0, 4, 6, 9, 11, 13),
+                                   ((year, 4), (month, 2), (day, 2), (hour, 2), (minute, 2), (second, 2))):
+        for i in range(width - 1, -1, -1):
+            value, digit = np.divmod(value, 10)
+            out[:, col + i] = digit + _ZERO
+    out[:, 8] = ord(' ')
+    return out
+
+
+def from_est(seconds, target):
+    """
+    Convert EST (no DST) epoch seconds to another time.
+    :param target: Offset in hours to add (e.g. +13 or -2), or an IANA zone name
+                   (e.g. 'Europe/London'), in which case DST of the target zone is applied.
+    """
+    if isinstance(target, (int, np.integer)):
+        return seconds + int(target) * 3600
+    import pandas as pd
+
+    utc = pd.DatetimeIndex((seconds - EST_UTC_OFFSET).astype('datetime64[s]'), tz='UTC')
+    return utc.tz_convert(target).tz_localize(None).as_unit('s').asi8
+
+
+def parse_target(value):
+    """
+    Read a target from the command line: an integer number of hours, or an IANA zone name.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        from zoneinfo import ZoneInfo
+
+        ZoneInfo(value)  # raises if the zone does not exist.
+        return value
+
+
+def convert_block(block, target):
+    """
+    Convert the timestamps at the start of every line of a block of histdata CSV.
+    :param block: bytes made of complete lines.
+    :return: The converted block, same length as the input.
+    """
+    buf = np.frombuffer(block, dtype=np.uint8).copy()
+    ends = np.flatnonzero(buf == _NEWLINE)
+    starts = np.concatenate(([0], ends + 1))
+    ends = np.concatenate((ends, [len(buf)]))
+    # Skip blank lines and anything too short to hold a timestamp (e.g. a trailing '\r').
+    starts = starts[ends - starts >= TIMESTAMP_WIDTH]
+    if len(starts) == 0:
+        return block
+    index = starts[:, None] + np.arange(TIMESTAMP_WIDTH)
+    buf[index] = format_timestamps(from_est(parse_timestamps(buf[index]), target))
+    return buf.tobytes()
+
+
+def convert_stream(src, dst, target, block_size=BLOCK_SIZE):
+    """
+    Copy a histdata CSV from one binary file object to another, converting its timestamps.
+    Memory use is bounded by block_size.
+    :return: Number of bytes written.
+    """
+    written = 0
+    rest = b''
+    while True:
+        block = src.read(block_size)
+        if not block:
+            break
+        block = rest + block
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            rest = block
+            continue
+        rest = block[cut:]
+        written += dst.write(convert_block(block[:cut], target))
+    if rest:
+        written += dst.write(convert_block(rest, target))
+    return written
@@ -0,0 +1,84 @@
+"""
+Recompress the archives downloaded by download_all_fx_data.py (replaces recompress-zip.sh).
+
+    python recompress_archives.py output                      # ZIP, deflate level 9
+    python recompress_archives.py output --method lzma        # ZIP, LZMA
+    python recompress_archives.py output --format csv.zst     # zstd compressed CSV
+    python recompress_archives.py output/eurusd --format parquet --price-type float32
+
+Archives are processed in parallel (FX_DATA_RECOMPRESS_WORKERS, default: all cores) and each one
+is replaced atomically, so the tool can be interrupted and run again at any time.
+"""
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from histdata.parquet import PRICE_TYPES
+from histdata.recompress import FORMATS, ZIP_METHODS, find_archives, recompress_archive, summarize
+from fx_logging import get_project_logger
+
+# Setup logging
+logger = get_project_logger(__name__)
+
+
+def recompress_all(root, output_format='zip', method='deflate', level=None, keep=False, workers=None,
+                   price_type='float64'):
+    """
+    Recompress every archive under root in a process pool.
+    :return: Per pair totals (see histdata.recompress.summarize).
+    """
+    archives = find_archives(root)
+    if workers is None:
+        workers = int(os.environ.get('FX_DATA_RECOMPRESS_WORKERS', os.cpu_count() or 1))
+    logger.info(f"Recompressing {len(archives)} archives under {root} to {output_format} with {workers} workers")
+
+    reports = []
+    # Largest archives first, so the pool does not end up waiting on one big archive.
+    archives.sort(key=os.path.getsize, reverse=True)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(recompress_archive, path, output_format, method, level, keep, price_type): path
+                   for path in archives}
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except Exception as e:
+                logger.error(f"Failed to recompress {futures[future]}: {e}")
+                continue
+            logger.debug("%s: %d -> %d bytes, read in %.3fs -> %.3fs, recompressed in %.2fs", report['path'],
+                         report['bytes_before'], report['bytes_after'], report['read_seconds_before'],
+                         report['read_seconds_after'], report['seconds'])
+            reports.append(report)
+
+    totals = summarize(reports)
+    for total in totals:
+        logger.info(f"{total['pair']}: {total['archives']} archives, "
+                    f"{total['bytes_before'] / 1e6:.1f} MB -> {total['bytes_after'] / 1e6:.1f} MB "
+                    f"({total['bytes_saved'] / 1e6:.1f} MB saved), read in {total['read_seconds_before']:.2f}s -> "
+                    f"{total['read_seconds_after']:.2f}s ({total['read_seconds_saved']:.2f}s saved), "
+                    f"recompressed in {total['seconds']:.1f}s")
+    saved = sum(t['bytes_saved'] for t in totals)
+    seconds_saved = sum(t['read_seconds_saved'] for t in totals)
+    logger.info(f"Recompressed {len(reports)}/{len(archives)} archives, {saved / 1e6:.1f} MB and "
+                f"{seconds_saved:.2f}s of reading saved")
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', nargs='?', default=os.environ.get('FX_DATA_OUTPUT', 'output'),
+                        help='Directory holding the DAT_*.zip archives (searched recursively).')
+    parser.add_argument('--format', default='zip', choices=sorted(FORMATS), help='Output format.')
+    parser.add_argument('--method', default='deflate', choices=sorted(ZIP_METHODS),
+                        help='Compression of the ZIP output.')
+    parser.add_argument('--level', type=int, help='Compression level (default: 9 for ZIP, 19 for zstd).')
+    parser.add_argument('--keep', action='store_true', help='Keep the archives after converting them to another format.')
+    parser.add_argument('--price-type', default='float64', choices=sorted(PRICE_TYPES),
+                        help='Type of the prices in the Parquet output.')
+    parser.add_argument('--workers', type=int, help='Worker processes.')
+    args = parser.parse_args(argv)
+    recompress_all(args.root, args.format, args.method, args.level, args.keep, args.workers, args.price_type)
+
+
+if __name__ == '__main__':
+    main()
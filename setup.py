@@ -9,5 +9,9 @@ setup(
     long_description_content_type='text/markdown',
     long_description=open('README.md').read(),
     packages=['histdata'],
-    install_requires=['requests', 'beautifulsoup4']
+    install_requires=['requests'],
+    # Only needed to write Delta tables or Parquet files, and to read them back.
+    extras_require={'delta': ['deltalake[pyarrow]', 'pandas', 'numpy'],
+                    'parquet': ['pyarrow', 'numpy'],
+                    'pandas': ['pandas']}
 )